@@ -2,14 +2,16 @@ from psycopg2 import connect, Error, extras
 
 
 class Postgres:
-    def __init__(self, db_conf, name):
+    def __init__(self, db_conf, name, compressed=False, lod_levels=None):
         self.db_conf = db_conf
         self.connection = None
         self.cursor = None
+        self.compressed = compressed  # blocks stored as (sfc_head, block BYTEA), see pcsfc.codec
 
         self.meta_table = "pc_metadata_" + name
         self.point_table = "pc_record_" + name
         self.btree_index = "btree_" + name
+        self.lod_levels = lod_levels or []  # levels of detail stored in pc_record_<name>_lod<level>
 
 
     def connect(self):
@@ -26,6 +28,9 @@ class Postgres:
             print("Error: Unable to connect to the database.")
             print(e)
 
+    def lod_table(self, level):
+        return f"{self.point_table}_lod{level}"
+
     def disconnect(self):
         if self.connection:
             self.cursor.close()
@@ -38,6 +43,13 @@ class Postgres:
             print("Error: Database connection is not established.")
             return
 
+        # Every block carries its point count and z range, for z filter pushdown and query planning
+        block_stats = "sfc_head INT, n_points INT, z_min DOUBLE PRECISION, z_max DOUBLE PRECISION"
+        if self.compressed:
+            point_columns = f"{block_stats}, block BYTEA"
+        else:
+            point_columns = f"{block_stats}, sfc_tail INT[], z DOUBLE PRECISION[]"
+
         create_table_sql = f"""
             CREATE EXTENSION IF NOT EXISTS postgis;
             CREATE TABLE IF NOT EXISTS {self.meta_table} (
@@ -48,14 +60,15 @@ class Postgres:
                 tail_length INT,
                 scales DOUBLE PRECISION[],
                 offsets DOUBLE PRECISION[],
-                bbox DOUBLE PRECISION[]
+                bbox DOUBLE PRECISION[],
+                compressed BOOLEAN,
+                lod_levels INT[],
+                block_count BIGINT
             );        
-            CREATE TABLE IF NOT EXISTS {self.point_table} (
-                sfc_head INT,
-                sfc_tail INT[],
-                z DOUBLE PRECISION[]
-            );
+            CREATE TABLE IF NOT EXISTS {self.point_table} ({point_columns});
             """
+        for level in self.lod_levels:
+            create_table_sql += f"CREATE TABLE IF NOT EXISTS {self.lod_table(level)} ({point_columns});"
         try:
             self.cursor.execute(create_table_sql)
             self.connection.commit()
@@ -79,32 +92,123 @@ class Postgres:
             print(e)
             self.connection.rollback()
 
+    def update_block_count(self):
+        # Rows of the point table, filled in once the import is done, for query planning
+        self.execute_sql(f"UPDATE {self.meta_table} SET block_count = (SELECT COUNT(*) FROM {self.point_table});")
+
     def insert_metadata(self, data):
         if not self.connection:
             print("Error: Database connection is not established.")
             return
 
         try:
-            self.cursor.execute(f"INSERT INTO {self.meta_table} VALUES (%s, %s, %s, %s, %s, %s, %s, %s);", data)
+            # block_count is left NULL until update_block_count
+            self.cursor.execute(f"INSERT INTO {self.meta_table} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);", data)
             self.connection.commit()
         except Error as e:
             print(f"Error: Unable to insert metadata.")
             print(e)
             self.connection.rollback()
 
-    def copy_points(self, file="pc_record.csv"):
+    def copy_points(self, file="pc_record.bin", table=None):
         if not self.connection:
             print("Error: Database connection is not established.")
-            return
+            return False
 
-        with open(file, 'r') as f:
+        table = table or self.point_table
+        with open(file, 'rb') as f:
             try:
-                self.cursor.copy_expert(sql=f"COPY {self.point_table} FROM stdin WITH CSV HEADER", file=f)
+                self.cursor.copy_expert(sql=f"COPY {table} FROM stdin WITH (FORMAT binary)", file=f)
                 self.connection.commit()
+                return True
             except Error as e:
                 print("Error: Unable to copy the data.")
                 print(e)
                 self.connection.rollback()
+                return False
+
+    def copy_stream(self, stream):
+        """
+        COPY binary data from a file-like stream, e.g. a pgcopy.CopyStream that
+        is still being filled by the encoder. The stream is closed afterwards.
+
+        Returns:
+            bool: whether the data was copied
+        """
+        if not self.connection:
+            print("Error: Database connection is not established.")
+            stream.close()
+            return False
+
+        try:
+            self.cursor.copy_expert(sql=f"COPY {self.point_table} FROM stdin WITH (FORMAT binary)", file=stream)
+            self.connection.commit()
+            return True
+        except Error as e:
+            print("Error: Unable to copy the data.")
+            print(e)
+            self.connection.rollback()
+            return False
+        finally:
+            stream.close()
+
+    def fragmentation_stats(self):
+        """
+        Reports how many rows share an sfc_head, e.g. after the tiles of a directory
+        were imported independently.
+
+        Returns:
+            dict: rows, heads, fragmented_heads, max_fragments, avg_fragments
+        """
+        sql = f"""
+            SELECT COALESCE(SUM(n), 0), COUNT(*), COUNT(*) FILTER (WHERE n > 1), COALESCE(MAX(n), 0)
+            FROM (SELECT COUNT(*) AS n FROM {self.point_table} GROUP BY sfc_head) AS fragments
+        """
+        self.cursor.execute(sql)
+        rows, heads, fragmented, max_fragments = self.cursor.fetchone()
+        return {
+            "rows": int(rows),
+            "heads": heads,
+            "fragmented_heads": fragmented,
+            "max_fragments": max_fragments,
+            "avg_fragments": round(int(rows) / heads, 3) if heads else 0
+        }
+
+    def compact_blocks(self, table=None):
+        """
+        Merges all rows of the same sfc_head into one block with sorted tails, so that
+        every head is stored once. Only the fragmented heads are rewritten.
+        """
+        table = table or self.point_table
+        if not self.connection:
+            print("Error: Database connection is not established.")
+            return
+        if self.compressed:
+            print("Error: Compaction is only supported for the array block format.")
+            return
+
+        sql = f"""
+            CREATE TEMP TABLE merged_blocks ON COMMIT DROP AS
+            SELECT b.sfc_head,
+                   array_agg(u.t ORDER BY u.t, u.z) AS sfc_tail,
+                   array_agg(u.z ORDER BY u.t, u.z) AS z,
+                   COUNT(*) AS n_points, MIN(u.z) AS z_min, MAX(u.z) AS z_max
+            FROM {table} AS b, unnest(b.sfc_tail, b.z) AS u(t, z)
+            WHERE b.sfc_head IN (
+                SELECT sfc_head FROM {table} GROUP BY sfc_head HAVING COUNT(*) > 1
+            )
+            GROUP BY b.sfc_head;
+            DELETE FROM {table} WHERE sfc_head IN (SELECT sfc_head FROM merged_blocks);
+            INSERT INTO {table} (sfc_head, n_points, z_min, z_max, sfc_tail, z)
+            SELECT sfc_head, n_points, z_min, z_max, sfc_tail, z FROM merged_blocks;
+        """
+        try:
+            self.cursor.execute(sql)
+            self.connection.commit()
+        except Error as e:
+            print("Error: Unable to compact the blocks.")
+            print(e)
+            self.connection.rollback()
 
     def execute_query(self, data, name="default"):
         sql = f"SELECT * FROM {self.point_table} WHERE sfc_head IN %(data)s"
@@ -116,7 +220,11 @@ class Postgres:
 
 
     def create_btree_index(self, name="default"):
-        sql = f"CREATE INDEX {self.btree_index} ON {self.point_table} USING btree (sfc_head)"
+        # Covering index, so the block statistics are read with index-only scans
+        sql = f"CREATE INDEX {self.btree_index} ON {self.point_table} USING btree (sfc_head) INCLUDE (n_points, z_min, z_max);"
+        for level in self.lod_levels:
+            sql += (f"CREATE INDEX {self.btree_index}_lod{level} ON {self.lod_table(level)} "
+                    f"USING btree (sfc_head) INCLUDE (n_points, z_min, z_max);")
         try:
             self.cursor.execute(sql)
             self.connection.commit()
@@ -0,0 +1,180 @@
+import queue
+import struct
+import threading
+import numpy as np
+
+from pcsfc.codec import encode_block
+
+
+# PostgreSQL binary COPY format, see the "Binary Format" section of the COPY documentation
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+INT4_OID = 23
+FLOAT8_OID = 701
+
+INT4_ELEM = np.dtype([('len', '>i4'), ('val', '>i4')])
+FLOAT8_ELEM = np.dtype([('len', '>i4'), ('val', '>f8')])
+
+
+# Signature, flags field and header extension length
+PGCOPY_HEADER = PGCOPY_SIGNATURE + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+
+def write_header(f):
+    f.write(PGCOPY_HEADER)
+
+
+def write_trailer(f):
+    f.write(PGCOPY_TRAILER)
+
+
+def pack_array(values, elem_dtype, elem_oid):
+    """
+    Packs a 1D NumPy array as the binary representation of a PostgreSQL array
+    without NULLs: ndim, has_null, element oid, dimension size, lower bound,
+    then (length, value) for each element.
+
+    Args:
+        values (np.ndarray): the array elements
+        elem_dtype (np.dtype): big-endian (length, value) record of one element
+        elem_oid (int): PostgreSQL type oid of the elements
+
+    Returns:
+        bytes: the array as a COPY field, including its length prefix
+    """
+    n = len(values)
+    elems = np.empty(n, dtype=elem_dtype)
+    elems['len'] = elem_dtype['val'].itemsize
+    elems['val'] = values
+    body = struct.pack('>iiiii', 1, 0, elem_oid, n, 1) + elems.tobytes()
+    return struct.pack('>i', len(body)) + body
+
+
+def pack_block_stats(n_fields, head, z):
+    """
+    Packs the field count and the leading (sfc_head INT, n_points INT, z_min DOUBLE PRECISION,
+    z_max DOUBLE PRECISION) fields shared by both block formats.
+    """
+    return struct.pack('>hiiiiidid', n_fields, 4, head, 4, len(z), 8, np.min(z), 8, np.max(z))
+
+
+def pack_block(head, sfc_tail, z):
+    """
+    Packs one (sfc_head, n_points, z_min, z_max, sfc_tail INT[], z DOUBLE PRECISION[]) row.
+    """
+    return (pack_block_stats(6, head, z)
+            + pack_array(sfc_tail, INT4_ELEM, INT4_OID)
+            + pack_array(z, FLOAT8_ELEM, FLOAT8_OID))
+
+
+def pack_compressed_block(head, sfc_tail, z):
+    """
+    Packs one (sfc_head, n_points, z_min, z_max, block BYTEA) row of the compact block format.
+    """
+    block = encode_block(sfc_tail, z)
+    return pack_block_stats(5, head, z) + struct.pack('>i', len(block)) + block
+
+
+def write_blocks(f, pt_blocks, compressed=False):
+    pack = pack_compressed_block if compressed else pack_block
+    for head, sfc_tail, z in pt_blocks:
+        f.write(pack(head, sfc_tail, z))
+
+
+POINT_ROW = np.dtype([('n', '>i2'), ('x_len', '>i4'), ('x', '>f8'), ('y_len', '>i4'), ('y', '>f8'),
+                      ('z_len', '>i4'), ('z', '>f8')])
+
+
+def pack_points(points):
+    """
+    Packs an (N, 3) array as binary COPY data of (x, y, z DOUBLE PRECISION) rows,
+    including the header and trailer.
+    """
+    rows = np.empty(len(points), dtype=POINT_ROW)
+    rows['n'] = 3
+    rows['x_len'] = rows['y_len'] = rows['z_len'] = 8
+    rows['x'], rows['y'], rows['z'] = points[:, 0], points[:, 1], points[:, 2]
+    return PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER
+
+
+class CopyStream:
+    """
+    File-like object that feeds binary COPY data to cursor.copy_expert while the
+    blocks are still being produced. A producer thread packs the blocks into a
+    bounded queue, so encoding and database ingest overlap and nothing is written
+    to disk. close() stops the producer when the COPY ends early.
+    """
+    def __init__(self, block_source, compressed=False, chunk_bytes=1 << 20, max_chunks=16):
+        self.block_source = block_source  # iterable of PointBlocks
+        self.pack = pack_compressed_block if compressed else pack_block
+        self.chunk_bytes = chunk_bytes
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.current = b""
+        self.pos = 0
+        self.finished = False
+        self.stop = threading.Event()  # set by close() when the consumer stops reading
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        # Gives up once stopped, so that the producer does not stay blocked on a full queue
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self):
+        try:
+            parts, size = [PGCOPY_HEADER], len(PGCOPY_HEADER)
+            for pt_blocks in self.block_source:
+                for head, sfc_tail, z in pt_blocks:
+                    row = self.pack(head, sfc_tail, z)
+                    parts.append(row)
+                    size += len(row)
+                    if size >= self.chunk_bytes:
+                        if not self.put(b"".join(parts)):
+                            return
+                        parts, size = [], 0
+            parts.append(PGCOPY_TRAILER)
+            if self.put(b"".join(parts)):
+                self.put(None)
+        except Exception as e:
+            self.put(e)
+        finally:
+            # Releases the reader, the sort runs and the LodWriter files of a generator source
+            close = getattr(self.block_source, "close", None)
+            if close is not None:
+                close()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+    def next_chunk(self):
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            self.finished = True
+            raise chunk
+        if chunk is None:
+            self.finished = True
+            chunk = b""
+        self.current, self.pos = chunk, 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and not self.finished:
+            if self.pos >= len(self.current):
+                self.next_chunk()
+                continue
+            end = len(self.current) if size < 0 else min(self.pos + size, len(self.current))
+            parts.append(self.current[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b"".join(parts)
+
+    def readline(self, size=-1):
+        return self.read(size)
@@ -67,26 +67,29 @@ class Pg2Las:
             print("Error: Unable to connect to the database.")
             print(e)
 
-    def read_data_from_pg(self):
-        self.cursor.execute(f"SELECT ST_X(point), ST_Y(point), ST_Z(point) FROM {self.table_name};")
-        res = self.cursor.fetchall()  # a list of tuples
-        my_data = np.array(res)
-        self.write_las_file(my_data)
-
-    def write_las_file(self, my_data, filename="query_results.las"):
+    def read_data_from_pg(self, chunk_size=1000000):
+        # A named (server-side) cursor streams the points, each chunk is written as it arrives
+        with self.connection.cursor(name="export_cursor") as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(f"SELECT ST_X(point), ST_Y(point), ST_Z(point) FROM {self.table_name};")
+            self.write_las_file(iter(lambda: cursor.fetchmany(chunk_size), []))
+
+    def write_las_file(self, chunks, filename="query_results.las"):
         filename = f"{self.table_name}.las"
         header = laspy.LasHeader(point_format=3, version="1.2")
         header.offsets = np.array([0, 0, 0])
         header.scales = np.array([0.1, 0.1, 0.1])
 
-        # 3. Create a LasWriter and a point record, then write it
+        # 3. Create a LasWriter, then write a point record per chunk
         with laspy.open(filename, mode="w", header=header) as writer:
-            point_record = laspy.ScaleAwarePointRecord.zeros(my_data.shape[0], header=header)
-            point_record.x = my_data[:, 0]
-            point_record.y = my_data[:, 1]
-            point_record.z = my_data[:, 2]
-
-            writer.write_points(point_record)
+            for chunk in chunks:
+                my_data = np.array(chunk, dtype=np.float64)
+                point_record = laspy.ScaleAwarePointRecord.zeros(my_data.shape[0], header=header)
+                point_record.x = my_data[:, 0]
+                point_record.y = my_data[:, 1]
+                point_record.z = my_data[:, 2]
+
+                writer.write_points(point_record)
 
     def disconnect(self):
         if self.connection:
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class PointBlocks:
+    """
+    Points sorted by (head, tail) and grouped per head. The blocks are handed
+    out as slices of the sorted arrays, so iterating does not copy the data.
+    """
+    def __init__(self, heads, starts, tails, z):
+        self.heads = heads    # one unique head per block
+        self.starts = starts  # offset of each block in tails/z, plus the total length at the end
+        self.tails = tails
+        self.z = z
+
+    @classmethod
+    def from_points(cls, heads, tails, z):
+        # One lexicographic sort: by head first, then by tail
+        order = np.lexsort((tails, heads))
+        heads, tails, z = heads[order], tails[order], z[order]
+
+        # A new block starts wherever the head changes
+        boundaries = np.flatnonzero(heads[1:] != heads[:-1]) + 1
+        if len(heads) == 0:
+            starts = np.zeros(1, dtype=np.int64)
+        else:
+            starts = np.concatenate(([0], boundaries, [len(heads)])).astype(np.int64)
+        return cls(heads[starts[:-1]], starts, tails, z)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def __iter__(self):
+        for i in range(len(self.heads)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        s, e = self.starts[i], self.starts[i + 1]
+        return int(self.heads[i]), self.tails[s:e], self.z[s:e]
+
+    def counts(self):
+        return np.diff(self.starts)
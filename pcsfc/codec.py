@@ -0,0 +1,138 @@
+import numpy as np
+from numba import njit
+
+
+# z is stored in centimetres, the precision kept by encode_split_points
+Z_SCALE = 100
+
+
+###############################################################################
+######################         Compact block codec         ####################
+###############################################################################
+# Block layout (bytea), all integers are LEB128 varints:
+#   n | first tail, tail deltas (n values) | zigzag z deltas in centimetres (n values)
+
+@njit(nogil=True)
+def write_varint(buf, pos, v):
+    while v >= 0x80:
+        buf[pos] = (v & 0x7f) | 0x80
+        v >>= 7
+        pos += 1
+    buf[pos] = v
+    return pos + 1
+
+
+@njit(nogil=True)
+def read_varint(buf, pos):
+    v = np.uint64(0)
+    shift = np.uint64(0)
+    while True:
+        b = np.uint64(buf[pos])
+        pos += 1
+        v |= (b & np.uint64(0x7f)) << shift
+        if b < np.uint64(0x80):
+            return v, pos
+        shift += np.uint64(7)
+
+
+@njit(nogil=True)
+def EncodeBlock(tails, z_cm):
+    """
+    Encodes one block of sorted tails and z values
+
+    Args:
+        tails (np.ndarray): int64 tails, sorted ascending
+        z_cm (np.ndarray): int64 z values in centimetres
+
+    Returns:
+        np.ndarray: uint8 buffer of the encoded block
+    """
+    n = tails.shape[0]
+    buf = np.empty(10 * (2 * n + 1), dtype=np.uint8)
+    pos = write_varint(buf, 0, np.uint64(n))
+
+    prev = np.int64(0)
+    for i in range(n):
+        pos = write_varint(buf, pos, np.uint64(tails[i] - prev))
+        prev = tails[i]
+
+    prev = np.int64(0)
+    for i in range(n):
+        d = z_cm[i] - prev
+        pos = write_varint(buf, pos, np.uint64((d << 1) ^ (d >> 63)))  # zigzag
+        prev = z_cm[i]
+
+    return buf[:pos]
+
+
+@njit(nogil=True)
+def DecodeBlockInto(buf, tails, z):
+    """
+    Decodes one block encoded by EncodeBlock into pre-sized output arrays
+
+    Args:
+        buf (np.ndarray): uint8 buffer of the encoded block
+        tails (np.ndarray): int64 output of at least n elements
+        z (np.ndarray): float64 output of at least n elements, in metres
+
+    Returns:
+        int: the number of points n
+    """
+    n, pos = read_varint(buf, 0)
+
+    prev = np.int64(0)
+    for i in range(n):
+        v, pos = read_varint(buf, pos)
+        prev += np.int64(v)
+        tails[i] = prev
+
+    prev = np.int64(0)
+    for i in range(n):
+        v, pos = read_varint(buf, pos)
+        d = np.int64(v >> np.uint64(1)) ^ -np.int64(v & np.uint64(1))  # zigzag
+        prev += d
+        z[i] = prev / Z_SCALE
+
+    return n
+
+
+@njit(nogil=True)
+def DecodeBlockZInto(buf, z):
+    """
+    Decodes only the z values of one block encoded by EncodeBlock, stepping over the tails
+
+    Args:
+        buf (np.ndarray): uint8 buffer of the encoded block
+        z (np.ndarray): float64 output of at least n elements, in metres
+
+    Returns:
+        int: the number of points n
+    """
+    n, pos = read_varint(buf, 0)
+
+    for i in range(n):
+        while buf[pos] >= 0x80:
+            pos += 1
+        pos += 1
+
+    prev = np.int64(0)
+    for i in range(n):
+        v, pos = read_varint(buf, pos)
+        d = np.int64(v >> np.uint64(1)) ^ -np.int64(v & np.uint64(1))  # zigzag
+        prev += d
+        z[i] = prev / Z_SCALE
+
+    return n
+
+
+def encode_block(sfc_tail, z):
+    z_cm = np.round(np.asarray(z, dtype=np.float64) * Z_SCALE).astype(np.int64)
+    return EncodeBlock(np.asarray(sfc_tail, dtype=np.int64), z_cm).tobytes()
+
+
+def decode_block_into(block, tails, z):
+    return DecodeBlockInto(np.frombuffer(block, dtype=np.uint8), tails, z)
+
+
+def decode_block_z_into(block, z):
+    return DecodeBlockZInto(np.frombuffer(block, dtype=np.uint8), z)
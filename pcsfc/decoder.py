@@ -1,5 +1,5 @@
 import numpy as np
-from numba import jit, int32, int64
+from numba import jit, njit, int32, int64, uint64
 
 @jit(int32(int64))
 def Compact2D(m):
@@ -77,4 +77,69 @@ def DecodeMorton2DY(mortonCode):
         int: 32 bit y coordinate in 2D
 
     """
-    return Compact2D(mortonCode >> 1)
\ No newline at end of file
+    return Compact2D(mortonCode >> 1)
+
+@njit(uint64(uint64), nogil=True)
+def Compact2DU64(m):
+    """
+    Unsigned variant of Compact2D: gathers the even bits of a 64 bit morton
+    code into a 32 bit number.
+
+    Args:
+        m (uint64): a 64 bit morton code
+
+    Returns:
+        uint64: a dimension in 2D space
+    """
+    m &= np.uint64(0x5555555555555555)
+    m = (m ^ (m >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    m = (m ^ (m >> np.uint64(2))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    m = (m ^ (m >> np.uint64(4))) & np.uint64(0x00ff00ff00ff00ff)
+    m = (m ^ (m >> np.uint64(8))) & np.uint64(0x0000ffff0000ffff)
+    m = (m ^ (m >> np.uint64(16))) & np.uint64(0x00000000ffffffff)
+    return m
+
+
+@njit(nogil=True)
+def DecodeJoinBatch(heads, tails, z, tail_len):
+    """
+    Joins heads and tails into morton codes and decodes them in one pass
+
+    Args:
+        heads (np.ndarray): int64 head of every point
+        tails (np.ndarray): int64 tail of every point
+        z (np.ndarray): float64 z of every point
+        tail_len (int): the number of bits kept in the tail
+
+    Returns:
+        np.ndarray: float64 (N, 3) array of x, y, z
+    """
+    n = heads.shape[0]
+    points = np.empty((n, 3), dtype=np.float64)
+    shift = np.uint64(tail_len)
+    for i in range(n):
+        key = (np.uint64(heads[i]) << shift) | np.uint64(tails[i])
+        points[i, 0] = Compact2DU64(key)
+        points[i, 1] = Compact2DU64(key >> np.uint64(1))
+        points[i, 2] = z[i]
+    return points
+
+
+@njit(nogil=True)
+def DecodeMorton2DBatch(keys):
+    """
+    Calculates the x, y coordinates of an array of morton codes
+
+    Args:
+        keys (np.ndarray): uint64 morton codes
+
+    Returns:
+        (np.ndarray, np.ndarray): int64 x and y coordinates
+    """
+    n = keys.shape[0]
+    x = np.empty(n, dtype=np.int64)
+    y = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        x[i] = Compact2DU64(keys[i])
+        y[i] = Compact2DU64(keys[i] >> np.uint64(1))
+    return x, y
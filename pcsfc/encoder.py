@@ -1,4 +1,5 @@
-from numba import jit, int32, int64
+import numpy as np
+from numba import jit, njit, int32, int64, uint64
 
 
 ###############################################################################
@@ -48,3 +49,67 @@ def EncodeMorton2D(x, y):
     return Expand2D(x) + (Expand2D(y) << 1)
 
 
+@njit(uint64(uint64), nogil=True)
+def Expand2DU64(n):
+    """
+    Unsigned variant of Expand2D: spreads the lower 32 bits of n over the
+    even bits of a 64 bit morton code.
+
+    Args:
+        n (uint64): a 2D dimension
+
+    Returns:
+        uint64: 64 bit morton code in 2D
+    """
+    b = n & np.uint64(0x00000000ffffffff)
+    b = (b ^ (b << np.uint64(16))) & np.uint64(0x0000ffff0000ffff)
+    b = (b ^ (b << np.uint64(8))) & np.uint64(0x00ff00ff00ff00ff)
+    b = (b ^ (b << np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    b = (b ^ (b << np.uint64(2))) & np.uint64(0x3333333333333333)
+    b = (b ^ (b << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return b
+
+
+@njit(nogil=True)
+def EncodeMorton2DBatch(x, y):
+    """
+    Calculates the 2D morton codes of whole coordinate arrays in one pass
+
+    Args:
+        x (np.ndarray): the x dimensions, non-negative integers
+        y (np.ndarray): the y dimensions, non-negative integers
+
+    Returns:
+        np.ndarray: uint64 morton codes in 2D
+    """
+    n = x.shape[0]
+    keys = np.empty(n, dtype=np.uint64)
+    for i in range(n):
+        keys[i] = Expand2DU64(np.uint64(x[i])) | (Expand2DU64(np.uint64(y[i])) << np.uint64(1))
+    return keys
+
+
+@njit(nogil=True)
+def EncodeSplitBatch(x, y, tail_len):
+    """
+    Encodes the x, y arrays with the morton curve and splits every key
+    into its head and tail
+
+    Args:
+        x (np.ndarray): the x dimensions, non-negative integers
+        y (np.ndarray): the y dimensions, non-negative integers
+        tail_len (int): the number of bits kept in the tail
+
+    Returns:
+        (np.ndarray, np.ndarray): int64 heads and int64 tails
+    """
+    n = x.shape[0]
+    heads = np.empty(n, dtype=np.int64)
+    tails = np.empty(n, dtype=np.int64)
+    shift = np.uint64(tail_len)
+    mask = (np.uint64(1) << shift) - np.uint64(1)
+    for i in range(n):
+        key = Expand2DU64(np.uint64(x[i])) | (Expand2DU64(np.uint64(y[i])) << np.uint64(1))
+        heads[i] = np.int64(key >> shift)
+        tails[i] = np.int64(key & mask)
+    return heads, tails
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+from pcsfc.blocks import PointBlocks
+
+
+# Rough number of bytes held in memory per point while a chunk is read, encoded and sorted:
+# the laspy record, the scaled x/y/z, the head/tail/z arrays and their sorted copies.
+BYTES_PER_POINT = 120
+
+
+def points_per_chunk(memory_limit, n_runs=1):
+    return max(memory_limit // (BYTES_PER_POINT * n_runs), 1)
+
+
+def write_run(run_dir, run_id, heads, tails, z):
+    """
+    Sorts one chunk by (head, tail) and spills it to disk as a sorted run.
+
+    Returns:
+        str: the path prefix of the run files
+    """
+    order = np.lexsort((tails, heads))
+    prefix = os.path.join(run_dir, f"run_{run_id}")
+    np.save(prefix + "_head.npy", heads[order])
+    np.save(prefix + "_tail.npy", tails[order])
+    np.save(prefix + "_z.npy", z[order])
+    return prefix
+
+
+def load_run(prefix):
+    # Memory-mapped, so only the pages touched by the merge are read
+    return (np.load(prefix + "_head.npy", mmap_mode='r'),
+            np.load(prefix + "_tail.npy", mmap_mode='r'),
+            np.load(prefix + "_z.npy", mmap_mode='r'))
+
+
+def merge_runs(prefixes, memory_limit):
+    """
+    K-way merge of the sorted runs into final head blocks, one window at a time.
+
+    Every window takes about `step` points from each run. The smallest last head of
+    those slices is the frontier: every run has all of its points up to and including
+    that head inside the window, so the blocks up to the frontier are complete.
+
+    Args:
+        prefixes (list): path prefixes of the sorted runs
+        memory_limit (int): memory ceiling in bytes
+
+    Yields:
+        PointBlocks: complete head blocks in ascending head order
+    """
+    runs = [load_run(prefix) for prefix in prefixes]
+    positions = [0] * len(runs)
+    step = points_per_chunk(memory_limit, max(len(runs), 1))
+
+    while True:
+        active = [i for i, run in enumerate(runs) if positions[i] < len(run[0])]
+        if not active:
+            break
+
+        frontier = min(runs[i][0][min(positions[i] + step, len(runs[i][0])) - 1] for i in active)
+
+        heads, tails, z = [], [], []
+        for i in active:
+            run_heads, run_tails, run_z = runs[i]
+            end = positions[i] + int(np.searchsorted(run_heads[positions[i]:], frontier, side='right'))
+            heads.append(np.asarray(run_heads[positions[i]:end]))
+            tails.append(np.asarray(run_tails[positions[i]:end]))
+            z.append(np.asarray(run_z[positions[i]:end]))
+            positions[i] = end
+
+        yield PointBlocks.from_points(np.concatenate(heads), np.concatenate(tails), np.concatenate(z))
@@ -0,0 +1,71 @@
+import numpy as np
+
+from pcsfc.blocks import PointBlocks
+from db.pgcopy import write_header, write_blocks, write_trailer
+
+
+def sample_blocks(pt_blocks, level, rng):
+    """
+    Spatially stratified subsample of sorted head blocks: one random point per
+    Morton cell of 4 ** level tails, i.e. per square of 2 ** level coordinate units.
+
+    Args:
+        pt_blocks (PointBlocks): blocks sorted by (head, tail)
+        level (int): the level of detail, 0 keeps every point
+        rng (np.random.Generator): picks the point of every cell
+
+    Returns:
+        PointBlocks: the sampled blocks, keyed by the same heads and tails
+    """
+    heads = np.repeat(pt_blocks.heads, pt_blocks.counts())
+    tails, z = pt_blocks.tails, pt_blocks.z
+    n = len(tails)
+    if n == 0:
+        return pt_blocks
+
+    # The points are sorted by (head, tail), so every cell is a contiguous run
+    cells = tails >> (2 * level)
+    new_cell = np.ones(n, dtype=bool)
+    new_cell[1:] = (heads[1:] != heads[:-1]) | (cells[1:] != cells[:-1])
+    starts = np.flatnonzero(new_cell)
+    ends = np.append(starts[1:], n)
+    picks = starts + (rng.random(len(starts)) * (ends - starts)).astype(np.int64)
+    return PointBlocks.from_points(heads[picks], tails[picks], z[picks])
+
+
+class LodWriter:
+    """
+    Writes the level-of-detail subsamples of the blocks passing through it into
+    one binary COPY file per level.
+    """
+    def __init__(self, levels, filenames, compressed=False):
+        self.levels = levels
+        self.filenames = filenames
+        self.compressed = compressed
+        self.rngs = [np.random.default_rng(level) for level in levels]
+        self.files = None
+
+    def open(self):
+        self.files = [open(filename, 'wb') for filename in self.filenames]
+        for f in self.files:
+            write_header(f)
+
+    def write(self, pt_blocks):
+        for level, rng, f in zip(self.levels, self.rngs, self.files):
+            write_blocks(f, sample_blocks(pt_blocks, level, rng), self.compressed)
+
+    def close(self):
+        for f in self.files:
+            write_trailer(f)
+            f.close()
+        self.files = None
+
+    def tee(self, block_source):
+        # Passes the blocks on unchanged, e.g. to a CopyStream, and writes the subsamples on the way
+        self.open()
+        try:
+            for pt_blocks in block_source:
+                self.write(pt_blocks)
+                yield pt_blocks
+        finally:
+            self.close()
@@ -1,16 +1,20 @@
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import laspy
-from itertools import groupby
-from collections import Counter
+import tempfile
 
-from pcsfc.encoder import EncodeMorton2D
+from pcsfc.encoder import EncodeMorton2D, EncodeMorton2DBatch, EncodeSplitBatch
+from pcsfc.blocks import PointBlocks
+from pcsfc.external_sort import points_per_chunk, write_run, merge_runs
+from db.pgcopy import write_header, write_blocks, write_trailer
 
 
-def compute_split_length(x, y, ratio):
+def key_length(x, y):
     mkey = EncodeMorton2D(x, y)
-    length = len(bin(mkey)) - 2
+    return len(bin(mkey)) - 2
+
+
+def compute_split_length(x, y, ratio):
+    length = key_length(x, y)
 
     head_len = int(length * ratio)
     if head_len % 2 != 0:
@@ -21,68 +25,133 @@ def compute_split_length(x, y, ratio):
     return head_len, tail_len
 
 
+def sample_points(paths, scales, offsets, sample_size=1000000, max_files=4, seed=0):
+    """
+    Reads an evenly strided sample of the scaled XY coordinates from at most
+    max_files randomly chosen files.
+
+    Returns:
+        (np.ndarray, np.ndarray, float): int64 x and y of the sample and the fraction
+            of the points of the chosen files that it holds
+    """
+    rng = np.random.default_rng(seed)
+    if len(paths) > max_files:
+        paths = [paths[i] for i in sorted(rng.choice(len(paths), max_files, replace=False))]
+
+    total = 0
+    for path in paths:
+        with laspy.open(path) as f:
+            total += f.header.point_count
+    step = max(total // sample_size, 1)
+
+    xs, ys = [], []
+    for path in paths:
+        with laspy.open(path) as reader:
+            for chunk in reader.chunk_iterator(step * 100000):
+                xs.append(np.asarray(chunk.x)[::step])
+                ys.append(np.asarray(chunk.y)[::step])
+
+    x = np.round((np.concatenate(xs) - offsets[0]) / scales[0]).astype(np.int64)
+    y = np.round((np.concatenate(ys) - offsets[1]) / scales[1]).astype(np.int64)
+    return x, y, 1 / step
+
+
+def weighted_percentiles(values, weights, percentiles):
+    order = np.argsort(values)
+    cum = np.cumsum(weights[order]) / weights.sum()
+    idx = np.minimum(np.searchsorted(cum, np.asarray(percentiles) / 100), len(values) - 1)
+    return values[order][idx]
+
+
+def auto_split_length(x, y, fraction, length, target):
+    """
+    Chooses the head length whose blocks hold about `target` points, judged by the block
+    of a typical point: the point-weighted median of the estimated block sizes. Heads and
+    tails are stored as INT, so neither may exceed 30 bits.
+
+    Args:
+        x (np.ndarray): scaled x of the sample
+        y (np.ndarray): scaled y of the sample
+        fraction (float): the share of the points in the sample
+        length (int): the length of the full Morton keys
+        target (int): the wanted number of points per block
+
+    Returns:
+        (int, int, list): head_len, tail_len and the 10th, 50th and 90th percentile of the
+            estimated points per block
+    """
+    keys = EncodeMorton2DBatch(x, y)
+    best = None
+    for head_len in range(2, min(length, 30) + 1, 2):
+        tail_len = length - head_len
+        if tail_len > 30:
+            continue
+        _, counts = np.unique(keys >> np.uint64(tail_len), return_counts=True)
+        sizes = counts / fraction
+        p10, p50, p90 = weighted_percentiles(sizes, counts, [10, 50, 90])
+        error = abs(np.log(p50 / target))
+        if best is None or error < best[0]:
+            best = (error, head_len, tail_len, [int(p10), int(p50), int(p90)])
+
+    _, head_len, tail_len, distribution = best
+    return head_len, tail_len, distribution
+
+
 class PointProcessor:
-    def __init__(self, path, tail_len, scales=None, offsets=None):
+    def __init__(self, path, tail_len, scales=None, offsets=None, memory_limit=None, compressed=False):
         self.path = path
         self.tail_len = tail_len
         self.scales = scales
         self.offsets = offsets
-
-    def execute(self, filename="pc_record.csv"):
-        las = laspy.read(self.path)
-        points = np.vstack((las.x, las.y, las.z)).transpose()
-        encoded_pts = self.encode_split_points(points)
-
-        # Sort and group the points
-        pt_blocks = self.make_groups(encoded_pts)
-        self.write_csv(pt_blocks, filename)
-
-
-    def encode_split_points(self, points):
-        encoded_points = []
-        for point in points:
-            # Scale and shift the XY coordinates
-            x = round((point[0] - self.offsets[0]) / self.scales[0])# scales should not be 0
-            y = round((point[1] - self.offsets[1]) / self.scales[1])
-            z = round(point[2], 2)
-
-            # Encode XY coordinates with Morton Curve
-            mkey = EncodeMorton2D(x, y)
-
-            # Split the Morton key into head and tail
-            head = mkey >> self.tail_len
-            tail = mkey - (head << self.tail_len)
-
-            # Save the point
-            encoded_points.append((head, tail, z))
-
-        return encoded_points
-
-    def make_groups(self, my_data):
-        # Group the list by the first element of each sublist
-        sorted_list = sorted(my_data, key=lambda x: x[0])  # Sort by SFC head
-        groups = groupby(sorted_list, lambda x: x[0])
-
-        # Pack the groups
-        pt_blocks = []
-        histogram = []
-        for key, group in groups:
-            sorted_group = sorted(list(group), key=lambda x: x[1])  # Sort by SFC tail
-            n = len(sorted_group)
-            sfc_tail = [sorted_group[i][1] for i in range(n)]
-            z = [sorted_group[i][2] for i in range(n)]
-            histogram.append((key, n))
-            pt_blocks.append((key, sfc_tail, z))
-
-        num_block = len(pt_blocks)
-        df_hist = pd.DataFrame(histogram, columns=['head', 'num_tail'])
-        df_hist.to_csv(f"histogram_{num_block}.csv", index=False)
-
-        return pt_blocks
-
-    def write_csv(self, pt_blocks, filename):
-        df = pd.DataFrame(pt_blocks, columns=['sfc_head', 'sfc_tail', 'z'])
-        df['sfc_tail'] = df['sfc_tail'].apply(lambda x: str(x).replace('[', '{').replace(']', '}'))
-        df['z'] = df['z'].apply(lambda x: str(x).replace('[', '{').replace(']', '}'))
-        df.to_csv(filename, index=False, mode='w')
-
+        self.memory_limit = memory_limit  # in bytes, None reads the whole file at once
+        self.compressed = compressed  # write the compact bytea block format
+
+    def execute(self, filename="pc_record.bin", lod=None):
+        # An optional LodWriter writes the level-of-detail files along the way
+        block_source = self.generate_blocks() if lod is None else lod.tee(self.generate_blocks())
+        with open(filename, 'wb') as f:
+            write_header(f)
+            for pt_blocks in block_source:
+                write_blocks(f, pt_blocks, self.compressed)
+            write_trailer(f)
+
+    def generate_blocks(self):
+        """
+        Yields the sorted head blocks of the file as PointBlocks, in ascending head order.
+        Without a memory limit the whole file is one PointBlocks.
+        """
+        if not self.memory_limit:
+            las = laspy.read(self.path)
+            encoded_pts = self.encode_split_points(las.x, las.y, las.z)
+
+            # Sort and group the points
+            yield self.make_groups(encoded_pts)
+            return
+
+        chunk_size = points_per_chunk(self.memory_limit)
+        with tempfile.TemporaryDirectory(prefix="pcsfc_runs_") as run_dir:
+            # 1. Read the file chunk by chunk, encode each chunk and spill it as a sorted run
+            prefixes = []
+            with laspy.open(self.path) as reader:
+                for chunk in reader.chunk_iterator(chunk_size):
+                    heads, tails, z = self.encode_split_points(chunk.x, chunk.y, chunk.z)
+                    prefixes.append(write_run(run_dir, len(prefixes), heads, tails, z))
+
+            # 2. Merge the runs into the final head blocks
+            yield from merge_runs(prefixes, self.memory_limit)
+
+    def encode_split_points(self, xs, ys, zs):
+        # Scale and shift the XY coordinates, scales should not be 0
+        x = np.round((np.asarray(xs) - self.offsets[0]) / self.scales[0]).astype(np.int64)
+        y = np.round((np.asarray(ys) - self.offsets[1]) / self.scales[1]).astype(np.int64)
+        z = np.round(np.asarray(zs, dtype=np.float64), 2)
+        if len(x) > 0 and (x.min() < 0 or y.min() < 0):
+            raise Exception("ERROR: Morton code is valid only for positive numbers")
+
+        # Encode XY coordinates with Morton Curve and split the keys into head and tail
+        heads, tails = EncodeSplitBatch(x, y, self.tail_len)
+        return heads, tails, z
+
+    def make_groups(self, encoded_pts):
+        heads, tails, z = encoded_pts
+        return PointBlocks.from_points(heads, tails, z)
@@ -1,47 +1,320 @@
-from pcsfc.decoder import DecodeMorton2D
+import numpy as np
+import shapely
+from numba import njit
+from shapely.geometry.base import BaseGeometry
 
+from pcsfc.decoder import Compact2DU64, DecodeMorton2DBatch
 
-def morton_range(bbox, start, body_len, end_len):
-    # Initialize
-    x_min, x_max, y_min, y_max = bbox[0], bbox[1], bbox[2], bbox[3]
-
-    nbits = body_len + end_len  # head_length + tail_length
-    base_units = [0, 1, 2, 3]  # Each slice has 4 sub-slice
-    fronts = [(start << nbits) | (base_unit << (nbits - 2)) for base_unit in base_units]
-    ranges = []
-
-    # Iterate through all possible Morton code slices, moving two bits at a time
-    for i in range(2, body_len, 2):
-        full_one_end = (1 << (nbits - i)) - 1  # nbits个1
-        overlaps = []
-        for slice_min in fronts:
-            slice_max = slice_min + full_one_end
-
-            xs_min, ys_min = DecodeMorton2D(slice_min)
-            xs_max, ys_max = DecodeMorton2D(slice_max)
-
-            # Fully containment
-            if xs_min >= x_min and xs_max <= x_max and ys_min >= y_min and ys_max <= y_max:
-                slice_min_lol = (slice_min >> end_len) - (start << body_len)
-                slice_max_lol = (slice_max >> end_len) - (start << body_len)
-                ranges.append([slice_min_lol, slice_max_lol])
-                #print(slice_min, slice_max, 'fully contained')
-            # No containment
-            elif xs_max < x_min or xs_min > x_max or ys_max < y_min or ys_min > y_max:
-                #print(slice_min, slice_max, 'no containment')
-                pass
-            # Overlap
+
+@njit(nogil=True)
+def MortonCoverKernel(x_min, x_max, y_min, y_max, start, body_len, end_len, max_depth):
+    """
+    Depth-first quadtree descent below the prefix `start`. Cells are visited in
+    morton order, so the emitted ranges are sorted and neighbours with the same
+    classification are merged on the fly.
+
+    Args:
+        x_min, x_max, y_min, y_max (float): the query box
+        start (int): the fixed prefix of the keys
+        body_len (int): the number of bits to descend over
+        end_len (int): the number of bits below the emitted granularity
+        max_depth (int): the deepest level (2 bits per level) that is split
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, np.ndarray): int64 range starts,
+            int64 range ends relative to `start`, bool full flags, and the
+            counts of full, partial and pruned cells
+    """
+    nbits = body_len + end_len
+    base = np.uint64(start) << np.uint64(nbits)
+    rel = np.uint64(start) << np.uint64(body_len)
+
+    stack_key = np.empty(4 * (nbits + 1), dtype=np.uint64)
+    stack_depth = np.empty(4 * (nbits + 1), dtype=np.int64)
+    stack_key[0] = base
+    stack_depth[0] = 0
+    top = 1
+
+    starts, ends, full = [], [], []
+    counts = np.zeros(3, dtype=np.int64)  # full, partial, pruned
+
+    while top > 0:
+        top -= 1
+        cell_min = stack_key[top]
+        depth = stack_depth[top]
+        free = nbits - 2 * depth
+        if free < end_len:
+            free = end_len
+        cell_max = cell_min | ((np.uint64(1) << np.uint64(free)) - np.uint64(1))
+
+        xs_min, ys_min = Compact2DU64(cell_min), Compact2DU64(cell_min >> np.uint64(1))
+        xs_max, ys_max = Compact2DU64(cell_max), Compact2DU64(cell_max >> np.uint64(1))
+
+        # No containment
+        if xs_max < x_min or xs_min > x_max or ys_max < y_min or ys_min > y_max:
+            counts[2] += 1
+            continue
+
+        contained = xs_min >= x_min and xs_max <= x_max and ys_min >= y_min and ys_max <= y_max
+        if contained or free == end_len or depth == max_depth:
+            s = np.int64((cell_min >> np.uint64(end_len)) - rel)
+            e = np.int64((cell_max >> np.uint64(end_len)) - rel)
+            counts[0 if contained else 1] += 1
+            # Merge with the previous range if they touch and have the same kind
+            if len(ends) > 0 and ends[-1] + 1 == s and full[-1] == contained:
+                ends[-1] = e
             else:
-                #print(slice_min, slice_max, 'overlaps')
-                new_units = [unit << (nbits - i - 2) for unit in base_units]
-                for new_unit in new_units:
-                    new_slice_min = slice_min | new_unit
-                    overlaps.append(new_slice_min)
-
-        fronts = overlaps
-        if len(fronts) == 0:
+                starts.append(s)
+                ends.append(e)
+                full.append(contained)
+            continue
+
+        # Overlap: split the cell, 1 bit when only an odd bit is left above end_len
+        split = 2 if free - end_len >= 2 else 1
+        child_shift = np.uint64(free - split)
+        for unit in range((1 << split) - 1, -1, -1):  # pushed in reverse, popped in morton order
+            stack_key[top] = cell_min | (np.uint64(unit) << child_shift)
+            stack_depth[top] = depth + 1
+            top += 1
+
+    n = len(starts)
+    out_starts = np.empty(n, dtype=np.int64)
+    out_ends = np.empty(n, dtype=np.int64)
+    out_full = np.empty(n, dtype=np.bool_)
+    for i in range(n):
+        out_starts[i] = starts[i]
+        out_ends[i] = ends[i]
+        out_full[i] = full[i]
+    return out_starts, out_ends, out_full, counts
+
+
+def classify_cells(region, xs_min, xs_max, ys_min, ys_max):
+    """
+    Classifies cells against a circle [[cx, cy], r] or a prepared shapely geometry.
+
+    Returns:
+        (np.ndarray, np.ndarray): bool flags of the cells fully inside and fully outside
+    """
+    if isinstance(region, BaseGeometry):
+        # Padded a little so that cells of one row or column of keys are still areas
+        boxes = shapely.box(xs_min - 1e-6, ys_min - 1e-6, xs_max + 1e-6, ys_max + 1e-6)
+        return shapely.contains_properly(region, boxes), ~shapely.intersects(region, boxes)
+
+    (cx, cy), r = region
+    near_x = np.maximum(np.maximum(xs_min - cx, cx - xs_max), 0)
+    near_y = np.maximum(np.maximum(ys_min - cy, cy - ys_max), 0)
+    far_x = np.maximum(np.abs(xs_min - cx), np.abs(xs_max - cx))
+    far_y = np.maximum(np.abs(ys_min - cy), np.abs(ys_max - cy))
+    return far_x ** 2 + far_y ** 2 <= r ** 2, near_x ** 2 + near_y ** 2 > r ** 2
+
+
+def geometry_cover(region, start, body_len, end_len, max_depth):
+    """
+    Quadtree descent like MortonCoverKernel, but against the real geometry of a
+    circle or polygon. The cells are classified a whole level at a time.
+    """
+    if isinstance(region, BaseGeometry):
+        shapely.prepare(region)
+
+    nbits = body_len + end_len
+    rel = np.uint64(start) << np.uint64(body_len)
+    cells = np.array([start], dtype=np.uint64) << np.uint64(nbits)
+    free, depth = nbits, 0
+    starts, ends, full = [], [], []
+    counts = np.zeros(3, dtype=np.int64)  # full, partial, pruned
+
+    while len(cells) > 0:
+        cells_max = cells | ((np.uint64(1) << np.uint64(free)) - np.uint64(1))
+        xs_min, ys_min = DecodeMorton2DBatch(cells)
+        xs_max, ys_max = DecodeMorton2DBatch(cells_max)
+        inside, outside = classify_cells(region, xs_min, xs_max, ys_min, ys_max)
+
+        leaf = inside | (~outside & (free == end_len or depth == max_depth))
+        starts.append(((cells[leaf] >> np.uint64(end_len)) - rel).astype(np.int64))
+        ends.append(((cells_max[leaf] >> np.uint64(end_len)) - rel).astype(np.int64))
+        full.append(inside[leaf])
+        counts += [inside.sum(), leaf.sum() - inside.sum(), outside.sum()]
+
+        # Split the partial cells, 1 bit when only an odd bit is left above end_len
+        split = ~(leaf | outside)
+        if not split.any():
             break
+        n_bits = 2 if free - end_len >= 2 else 1
+        free, depth = free - n_bits, depth + 1
+        units = np.arange(1 << n_bits, dtype=np.uint64) << np.uint64(free)
+        cells = (cells[split][:, None] | units[None, :]).ravel()
+
+    starts, ends, full = np.concatenate(starts), np.concatenate(ends), np.concatenate(full)
+    order = np.argsort(starts, kind='stable')
+    starts, ends, full = merge_touching(starts[order], ends[order], full[order])
+    return starts, ends, full, counts
+
+
+def merge_touching(starts, ends, full):
+    """
+    Merges sorted ranges that touch and have the same kind.
+    """
+    if len(starts) == 0:
+        return starts, ends, full
+    joined = (starts[1:] == ends[:-1] + 1) & (full[1:] == full[:-1])
+    first = np.concatenate(([True], ~joined))
+    last = np.concatenate((~joined, [True]))
+    return starts[first], ends[last], full[first]
+
+
+def apply_range_budget(starts, ends, full, max_ranges):
+    """
+    Merges the ranges separated by the smallest gaps until at most max_ranges are
+    left. A merged range is partial: it may contain heads outside the query.
+    """
+    if max_ranges is None or len(starts) <= max_ranges:
+        return starts, ends, full
+
+    max_ranges = max(max_ranges, 1)
+    gaps = starts[1:] - ends[:-1]
+    n_merge = len(starts) - max_ranges
+    merged = np.zeros(len(gaps), dtype=bool)
+    merged[np.argpartition(gaps, n_merge - 1)[:n_merge]] = True
+
+    first = np.concatenate(([True], ~merged))  # ranges that open a new merged range
+    last = np.concatenate((~merged, [True]))
+    group = np.cumsum(first) - 1
+    sizes = np.bincount(group)
+    new_full = full[first] & (sizes == 1)
+    return starts[first], ends[last], new_full
+
+
+def morton_cover(region, start, body_len, end_len, max_ranges=None, max_depth=None):
+    """
+    Decomposes the query region into sorted, merged ranges of keys below `start`.
+
+    Args:
+        region: a box [x_min, x_max, y_min, y_max], a circle [[cx, cy], r] or a shapely polygon
+        start (int): the fixed prefix of the keys, e.g. 0 for heads or an sfc_head for tails
+        body_len (int): the number of bits to descend over
+        end_len (int): the number of bits below the emitted granularity
+        max_ranges (int): optional range budget, close ranges are merged into partial ones
+        max_depth (int): optional deepest quadtree level, coarser partial cells are emitted
+
+    Returns:
+        (np.ndarray, np.ndarray, dict): (k, 2) int64 ranges relative to `start`,
+            bool flags telling which ranges are fully inside the region, and the
+            counts of full, partial and pruned cells
+    """
+    if max_depth is None:
+        max_depth = body_len
+    if isinstance(region, BaseGeometry) or len(region) == 2:
+        starts, ends, full, counts = geometry_cover(region, start, body_len, end_len, max_depth)
+    else:
+        starts, ends, full, counts = MortonCoverKernel(float(region[0]), float(region[1]), float(region[2]),
+                                                       float(region[3]), start, body_len, end_len, max_depth)
+    starts, ends, full = apply_range_budget(starts, ends, full, max_ranges)
+
+    stats = {"full": int(counts[0]), "partial": int(counts[1]), "pruned": int(counts[2]), "ranges": len(starts)}
+    return np.column_stack((starts, ends)), full, stats
+
+
+def partition_ranges(ranges, full, weights, n_parts):
+    """
+    Splits sorted ranges into at most n_parts contiguous partitions of about equal
+    weight, e.g. the expected number of points. Ranges heavier than one partition
+    are cut into equal pieces first.
+
+    Args:
+        ranges (np.ndarray): (k, 2) int64 ranges
+        full (np.ndarray): bool flags of the ranges
+        weights (np.ndarray): weight of every range
+        n_parts (int): the number of partitions
+
+    Returns:
+        list: (ranges, full) of every non-empty partition
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+    if len(ranges) == 0 or n_parts <= 1 or total <= 0:
+        return [(ranges, full)]
+    target = total / n_parts
+
+    # 1. Cut the heavy ranges into pieces
+    pieces = np.minimum(np.ceil(weights / target).astype(np.int64), ranges[:, 1] - ranges[:, 0] + 1)
+    pieces = np.maximum(pieces, 1)
+    idx = np.repeat(np.arange(len(ranges)), pieces)
+    k = np.arange(len(idx)) - np.repeat(np.cumsum(pieces) - pieces, pieces)  # piece number within its range
+    span = ranges[idx, 1] - ranges[idx, 0] + 1
+    starts = ranges[idx, 0] + span * k // pieces[idx]
+    ends = ranges[idx, 0] + span * (k + 1) // pieces[idx] - 1
+    split_ranges = np.column_stack((starts, ends))
+    split_full = full[idx]
+    split_weights = weights[idx] / pieces[idx]
+
+    # 2. Assign contiguous runs of pieces to the partitions by cumulative weight
+    cum = np.cumsum(split_weights) - split_weights / 2
+    part = np.minimum((cum / target).astype(np.int64), n_parts - 1)
+    return [(split_ranges[part == p], split_full[part == p]) for p in range(n_parts) if (part == p).any()]
+
+
+def subtract_ranges(ranges, removed):
+    """
+    Removes the keys of `removed` from `ranges`, e.g. the heads of an inner ring
+    that were already searched.
+
+    Args:
+        ranges (np.ndarray): (k, 2) sorted, disjoint [start, end] ranges
+        removed (np.ndarray): (m, 2) sorted, disjoint [start, end] ranges
+
+    Returns:
+        np.ndarray: (n, 2) int64 ranges of the keys in `ranges` but not in `removed`
+    """
+    out = []
+    j = 0
+    for start, end in ranges:
+        while j < len(removed) and removed[j][1] < start:
+            j += 1
+        i = j
+        while i < len(removed) and removed[i][0] <= end:
+            if removed[i][0] > start:
+                out.append([start, removed[i][0] - 1])
+            start = max(start, removed[i][1] + 1)
+            i += 1
+        if start <= end:
+            out.append([start, end])
+    return np.array(out, dtype=np.int64).reshape(-1, 2)
+
+
+def morton_range(bbox, start, body_len, end_len):
+    """
+    Returns the ranges fully inside the box and the partially overlapping keys
+    at the finest granularity.
+    """
+    ranges, full, stats = morton_cover(bbox, start, body_len, end_len)
+    partial = ranges[~full]
+    overlaps = np.concatenate([np.arange(s, e + 1) for s, e in partial]) if len(partial) else np.empty(0, np.int64)
+    return ranges[full].tolist(), overlaps.tolist()
+
+
+def tails_in_ranges(sfc_tail, ranges):
+    """
+    Selects the tails of a block that fall inside any of the [start, end] ranges,
+    using that the tails of a block are sorted: each range is located with two
+    binary searches instead of testing every tail against every range.
+
+    Args:
+        sfc_tail (np.ndarray): sorted tails of one block
+        ranges (list): [start, end] tail ranges, e.g. from morton_range
+
+    Returns:
+        np.ndarray: boolean mask over sfc_tail
+    """
+    n = len(sfc_tail)
+    if n == 0 or len(ranges) == 0:
+        return np.zeros(n, dtype=bool)
+
+    ranges = np.asarray(ranges, dtype=np.int64)
+    lo = np.searchsorted(sfc_tail, ranges[:, 0], side='left')
+    hi = np.searchsorted(sfc_tail, ranges[:, 1], side='right')
 
-    overlaps_shift = [(key >> end_len) - (start << body_len)for key in overlaps]
-    #overlaps_shift =
-    return ranges, overlaps_shift
\ No newline at end of file
+    # +1 where a selected run of tails starts, -1 where it ends
+    delta = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(delta, lo, 1)
+    np.add.at(delta, hi, -1)
+    return np.cumsum(delta[:-1]) > 0
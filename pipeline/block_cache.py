@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    """
+    LRU cache of decoded head blocks, keyed by (dataset, sfc_head), with a byte budget.
+    It is shared by all queries of a Querier session and by its worker threads.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, dataset, sfc_head):
+        with self.lock:
+            block = self.blocks.get((dataset, sfc_head))
+            if block is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end((dataset, sfc_head))
+            self.hits += 1
+            return block
+
+    def put(self, dataset, sfc_head, sfc_tail, z):
+        size = sfc_tail.nbytes + z.nbytes
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.blocks.pop((dataset, sfc_head), None)
+            if old is not None:
+                self.bytes -= old[0].nbytes + old[1].nbytes
+            self.blocks[(dataset, sfc_head)] = (sfc_tail, z)
+            self.bytes += size
+
+            # Evict the least recently used blocks
+            while self.bytes > self.max_bytes:
+                _, (old_tail, old_z) = self.blocks.popitem(last=False)
+                self.bytes -= old_tail.nbytes + old_z.nbytes
+
+    def stats(self):
+        return {"blocks": len(self.blocks), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
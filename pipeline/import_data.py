@@ -1,11 +1,46 @@
 import os
 import time
+import queue
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import laspy
 
-from pcsfc.point_processor import compute_split_length, PointProcessor
+from pcsfc.point_processor import compute_split_length, key_length, sample_points, auto_split_length, PointProcessor
+from pcsfc.lod import LodWriter
 from db import Postgres
+from db.pgcopy import CopyStream
+
+
+def get_memory_limit(dict):
+    # Optional "memory_limit" in MB switches the import to chunked streaming
+    if dict.get("memory_limit"):
+        return int(dict["memory_limit"]) * 1024 * 1024
+    return None
+
+
+def get_lod_levels(levels, tail_len):
+    # Level l keeps one point per 2**l x 2**l cell, at most one point per head
+    levels = sorted(set(levels))
+    valid = [level for level in levels if 0 < level <= tail_len // 2]
+    if len(valid) < len(levels):
+        print(f"Warning: LOD levels must be within 1..{tail_len // 2}, using {valid}.")
+    return valid
+
+
+def get_lod_files(prefix, levels):
+    return [f"{prefix}_lod{level}.bin" for level in levels]
+
+
+def auto_split(paths, x_max, y_max, scales, offsets, target):
+    # Sample the input and split the keys so that the blocks hold about `target` points
+    length = key_length(round((x_max - offsets[0]) / scales[0]), round((y_max - offsets[1]) / scales[1]))
+    x, y, fraction = sample_points(paths, scales, offsets)
+    head_len, tail_len, distribution = auto_split_length(x, y, fraction, length, target)
+    print(f"-> Auto split: head {head_len}, tail {tail_len}, points per block p10/p50/p90 {distribution}")
+    return head_len, tail_len
 
 
 class FileLoader:
@@ -13,11 +48,19 @@ class FileLoader:
         self.name = name
         self.path = dict["path"]
         self.srid = dict["srid"]
-        self.ratio = dict["ratio"]
+        self.ratio = dict.get("ratio")
+        self.target_block_size = dict.get("target_block_size")  # Choose the split from a sample instead of ratio
 
         self.scales = dict["scales"]
         self.offsets = dict["offsets"]
         self.tail_len = None
+        self.memory_limit = get_memory_limit(dict)
+        self.pipelined = dict.get("pipelined", False)  # Encode while COPY ingests, without pc_record file
+        self.compressed = dict.get("compressed", False)  # Compact bytea blocks, see pcsfc.codec
+        self.record_file = f"pc_record_{name}.bin"
+        self.lod_config = dict.get("lod_levels", [])  # Optional levels of detail, e.g. [2, 4, 6]
+        self.lod_levels = []
+        self.lod_files = []
 
         self.meta = self.get_metadata()
         print(self.meta)
@@ -30,27 +73,46 @@ class FileLoader:
 
             X_max = round((f.header.x_max - self.offsets[0]) / self.scales[0])
             Y_max = round((f.header.y_max - self.offsets[1]) / self.scales[1])
-            head_len, self.tail_len = compute_split_length(X_max, Y_max, self.ratio)
+            if self.target_block_size:
+                head_len, self.tail_len = auto_split([self.path], f.header.x_max, f.header.y_max, self.scales,
+                                                     self.offsets, self.target_block_size)
+            else:
+                head_len, self.tail_len = compute_split_length(X_max, Y_max, self.ratio)
 
-        meta = [self.name, self.srid, point_count, head_len, self.tail_len, self.scales, self.offsets, bbox]
+        self.lod_levels = get_lod_levels(self.lod_config, self.tail_len)
+        self.lod_files = get_lod_files(f"pc_record_{self.name}", self.lod_levels)
+        meta = [self.name, self.srid, point_count, head_len, self.tail_len, self.scales, self.offsets, bbox,
+                self.compressed, self.lod_levels]
         return meta
 
     def preparation(self):
-        processor = PointProcessor(self.path, self.tail_len, self.scales, self.offsets)
-        processor.execute()
+        self.processor = PointProcessor(self.path, self.tail_len, self.scales, self.offsets, self.memory_limit,
+                                        self.compressed)
+        self.lod = LodWriter(self.lod_levels, self.lod_files, self.compressed) if self.lod_levels else None
+        if not self.pipelined:
+            self.processor.execute(self.record_file, self.lod)
 
     def loading(self, db_conf):
         start_time = time.time()
-        db = Postgres(db_conf, self.name)
+        db = Postgres(db_conf, self.name, self.compressed, self.lod_levels)
         db.connect()
 
         db.create_table()
         db.insert_metadata(self.meta)
-        db.copy_points()
+        if self.pipelined:
+            block_source = self.processor.generate_blocks()
+            block_source = block_source if self.lod is None else self.lod.tee(block_source)
+            copied = db.copy_stream(CopyStream(block_source, self.compressed))
+        else:
+            copied = db.copy_points(self.record_file)
+        if copied:  # the levels of detail are incomplete when the points were not copied
+            for level, lod_file in zip(self.lod_levels, self.lod_files):
+                db.copy_points(lod_file, db.lod_table(level))
 
         load_time = time.time()
         print("-> Loading time:", round(load_time - start_time, 2))
 
+        db.update_block_count()
         db.create_btree_index()
         db.disconnect()
         print("-> Close time:", round(time.time() - load_time, 2))
@@ -61,13 +123,24 @@ class DirLoader:
         self.name = name
         self.paths = self.get_file_paths(dict["path"])
         self.srid = dict["srid"]
-        self.ratio = dict["ratio"]
+        self.ratio = dict.get("ratio")
+        self.target_block_size = dict.get("target_block_size")  # Choose the split from a sample instead of ratio
 
         self.scales = dict["scales"]
         self.offsets = dict["offsets"]
 
         self.tail_len = None
         self.csv_list = None
+        self.memory_limit = get_memory_limit(dict)
+        self.pipelined = dict.get("pipelined", False)
+        self.compressed = dict.get("compressed", False)
+        self.record_file = f"pc_record_{name}.bin"
+        self.workers = dict.get("workers", 1)  # Processes encoding files in parallel
+        self.copy_connections = dict.get("copy_connections", 1)  # Long-lived COPY writers
+        self.compact = dict.get("compact", False)  # Merge the fragments of a head from different files
+        self.lod_config = dict.get("lod_levels", [])  # Optional levels of detail, e.g. [2, 4, 6]
+        self.lod_levels = []
+        self.lod_files = []
 
         self.meta = self.get_metadata()
         print("The number of files: ", len(self.paths))
@@ -94,12 +167,24 @@ class DirLoader:
         bbox = [x_min, x_max, y_min, y_max, z_min, z_max]
 
         # 2. Based on the bbox of the whole point cloud, determine head_length and tail_length
-        head_len, self.tail_len = compute_split_length(round(x_min), round(y_max), self.ratio)
-        meta = [self.name, self.srid, point_count, head_len, self.tail_len, self.scales, self.offsets, bbox]
+        if self.target_block_size:
+            head_len, self.tail_len = auto_split(self.paths, x_max, y_max, self.scales, self.offsets,
+                                                 self.target_block_size)
+        else:
+            head_len, self.tail_len = compute_split_length(round(x_min), round(y_max), self.ratio)
+
+        self.lod_levels = get_lod_levels(self.lod_config, self.tail_len)
+        self.lod_files = get_lod_files(f"pc_record_{self.name}", self.lod_levels)
+        meta = [self.name, self.srid, point_count, head_len, self.tail_len, self.scales, self.offsets, bbox,
+                self.compressed, self.lod_levels]
         return meta
 
     def run(self, db_conf):
-        db = Postgres(db_conf, self.name)
+        if self.workers > 1:
+            self.run_parallel(db_conf)
+            return
+
+        db = Postgres(db_conf, self.name, self.compressed, self.lod_levels)
         db.connect()
 
         db.create_table()
@@ -111,34 +196,131 @@ class DirLoader:
                 print(i, " is being processed.")
 
             # Preparation: Encode, split and group the Morton keys
-            processor = PointProcessor(self.paths[i], self.tail_len, self.scales, self.offsets)
-            processor.execute()
+            processor = PointProcessor(self.paths[i], self.tail_len, self.scales, self.offsets, self.memory_limit,
+                                       self.compressed)
+            lod = LodWriter(self.lod_levels, self.lod_files, self.compressed) if self.lod_levels else None
+            if not self.pipelined:
+                processor.execute(self.record_file, lod)
 
-            # Import the data into the database
+            # Import the data into the database over the one connection
             load_time_1 = time.time()
-            db = Postgres(db_conf, self.name)
-            db.connect()
-            if i == 0:
-                db.create_table()
-                db.insert_metadata(self.meta)
-
-            db.copy_points()
-
-            if i == (len(self.paths)-1):
-                close_time_1 = time.time()
-                db.create_btree_index()
-                db.disconnect()
-                close_time_count = time.time() - close_time_1
-
+            if self.pipelined:
+                block_source = processor.generate_blocks() if lod is None else lod.tee(processor.generate_blocks())
+                copied = db.copy_stream(CopyStream(block_source, self.compressed))
             else:
-                db.disconnect()
-
+                copied = db.copy_points(self.record_file)
+            if copied:  # the levels of detail are incomplete when the points were not copied
+                for level, lod_file in zip(self.lod_levels, self.lod_files):
+                    db.copy_points(lod_file, db.lod_table(level))
             load_time_count += time.time() - load_time_1
 
-        print("-> Load time:", round(load_time_count-(close_time_count), 2))
+        close_time_1 = time.time()
+        self.compaction(db)
+        db.update_block_count()
+        db.create_btree_index()
+        db.disconnect()
+        close_time_count = time.time() - close_time_1
+
+        print("-> Load time:", round(load_time_count, 2))
         print("-> Close time:", round(close_time_count, 2))
 
+    def run_parallel(self, db_conf):
+        db = Postgres(db_conf, self.name, self.compressed, self.lod_levels)
+        db.connect()
+        db.create_table()
+        db.insert_metadata(self.meta)
+
+        start_time = time.time()
+        with tempfile.TemporaryDirectory(prefix=f"pc_record_{self.name}_") as tmp_dir:
+            # 1. COPY writers: each keeps one connection open and drains the encoded files
+            encoded_files = queue.Queue()
+            window = threading.Semaphore(2 * self.workers)  # files being encoded or waiting on disk for COPY
+            errors = []  # failures of the COPY writers, which keep draining the queue afterwards
+            writers = [threading.Thread(target=copy_writer, args=(db_conf, self.name, encoded_files, self.compressed,
+                                                                  self.lod_levels, window, errors))
+                       for _ in range(self.copy_connections)]
+            for writer in writers:
+                writer.start()
+
+            def queue_encoded(future):
+                # A failed file never reaches a writer, so its slot is released here
+                if future.exception() is None:
+                    encoded_files.put(future.result())
+                else:
+                    window.release()
+
+            # 2. Encode, split and group the files in worker processes, a bounded window at a time
+            jobs = [(path, os.path.join(tmp_dir, f"{i}.bin"), self.tail_len, self.scales, self.offsets,
+                     self.memory_limit, self.compressed, self.lod_levels) for i, path in enumerate(self.paths)]
+            try:
+                futures = []
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    for i, job in enumerate(jobs):
+                        window.acquire()
+                        if errors or any(future.done() and future.exception() for future in futures):
+                            break
+                        if i % 50 == 0:
+                            print(i, " is being processed.")
+                        futures.append(pool.submit(encode_file, job))
+                        futures[-1].add_done_callback(queue_encoded)
+                for future in futures:
+                    future.result()  # raises the first encoding error
+            finally:
+                for _ in writers:
+                    encoded_files.put(None)
+                for writer in writers:
+                    writer.join()
+            if errors:
+                raise errors[0]
+
+        close_time = time.time()
+        print("-> Load time:", round(close_time - start_time, 2))
+
+        self.compaction(db)
+        db.update_block_count()
+        db.create_btree_index()
+        db.disconnect()
+        print("-> Close time:", round(time.time() - close_time, 2))
+
+    def compaction(self, db):
+        stats = db.fragmentation_stats()
+        print("-> Fragmentation:", stats)
+        if self.compact and stats["fragmented_heads"] > 0:
+            db.compact_blocks()
+            for level in self.lod_levels:
+                db.compact_blocks(db.lod_table(level))
+            print("-> Fragmentation after compaction:", db.fragmentation_stats())
 
     def get_file_paths(self, dir_path):
         return [os.path.join(dir_path, file) for file in os.listdir(dir_path) if
-                      os.path.isfile(os.path.join(dir_path, file))]
\ No newline at end of file
+                      os.path.isfile(os.path.join(dir_path, file))]
+
+def encode_file(job):
+    # Runs in a worker process: encode one LAS file into a binary COPY file
+    path, record_file, tail_len, scales, offsets, memory_limit, compressed, lod_levels = job
+    processor = PointProcessor(path, tail_len, scales, offsets, memory_limit, compressed)
+    lod_files = get_lod_files(record_file[:-len(".bin")], lod_levels)
+    processor.execute(record_file, LodWriter(lod_levels, lod_files, compressed) if lod_levels else None)
+    return record_file
+
+
+def copy_writer(db_conf, name, encoded_files, compressed, lod_levels, window, errors):
+    db = Postgres(db_conf, name, compressed, lod_levels)
+    db.connect()
+    while True:
+        record_file = encoded_files.get()
+        if record_file is None:
+            break
+        try:
+            # After a failure the remaining files are only drained, the temporary directory removes them
+            if not errors:
+                db.copy_points(record_file)
+                os.remove(record_file)
+                for level, lod_file in zip(lod_levels, get_lod_files(record_file[:-len(".bin")], lod_levels)):
+                    db.copy_points(lod_file, db.lod_table(level))
+                    os.remove(lod_file)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            window.release()  # lets the next file be encoded
+    db.disconnect()
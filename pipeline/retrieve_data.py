@@ -1,20 +1,49 @@
+import io
+import heapq
+import queue
+import threading
 import numpy as np
 import pandas as pd
 import laspy
+from concurrent.futures import ThreadPoolExecutor
 
+import shapely
 from shapely.wkt import loads
+from shapely.geometry.base import BaseGeometry
 from psycopg2 import connect, Error, extras
+from psycopg2.pool import ThreadedConnectionPool
 
-from pcsfc.decoder import DecodeMorton2D
-from pcsfc.range_search import morton_range
+from pcsfc.decoder import DecodeJoinBatch
+from pcsfc.range_search import morton_range, morton_cover, tails_in_ranges, partition_ranges, subtract_ranges
+from pcsfc.codec import decode_block_into, decode_block_z_into
+from db.pgcopy import pack_points
+
+
+# Planner costs, in units of one block fetched through the index
+RANGE_COST = 4  # descending the B-tree for one head range
+SCAN_BLOCK_COST = 0.25  # reading one block in a sequential scan
+MIN_RANGES = 64  # the planner never merges the ranges below this budget
 
 
 class Querier:
-    def __init__(self, head_len, tail_len, db_conf, source_table, name):
+    def __init__(self, head_len, tail_len, db_conf, source_table, name, compressed=None, max_ranges=None,
+                 materialize=True, batch_size=1000, workers=1, cache=None, max_points=None, density=None):
         self.head_len = head_len
         self.tail_len = tail_len
-        self.source_table = source_table
+        self.base_table = source_table
+        self.source_table = source_table  # the base table, or the level of detail a range search reads from
         self.name = name
+        self.compressed = compressed  # source blocks are stored as (sfc_head, block BYTEA), None reads the metadata
+        self.max_ranges = max_ranges  # budget of head ranges sent to the database
+        self.materialize = materialize  # write the result into a PostGIS table, else only return the points
+        self.batch_size = batch_size  # blocks fetched from the server-side cursor at a time
+        self.workers = workers  # partitions of the head ranges fetched and decoded in parallel
+        self.cache = cache  # optional BlockCache shared by the queries of a session
+        self.max_points = max_points  # optional point budget of a range search, see choose_level
+        self.density = density  # optional target density in points per square unit, see choose_level
+        self.meta = None  # pc_metadata_<name> of the source dataset, read on first use
+        self.db_conf = db_conf
+        self.pool = None
 
         try:
             self.connection = connect(
@@ -28,134 +57,743 @@ class Querier:
         except Error as e:
             print("Error: Unable to connect to the database.")
             print(e)
+            return
+
+        # Without given lengths, use the split chosen at import time
+        if self.head_len is None or self.tail_len is None:
+            meta = self.metadata()
+            self.head_len, self.tail_len = meta["head_length"], meta["tail_length"]
+        # Without a given storage format, use the one written at import time
+        if self.compressed is None:
+            self.compressed = bool(self.metadata().get("compressed"))
+
 
+    def geometry_query(self, mode, geometry, minz=None, maxz=None):
+        if not self.materialize:
+            return self.query(mode, geometry, minz, maxz)
 
-    def geometry_query(self, mode, geometry):
+        if mode == "nn":
+            self.create_result_table([self.nn_query(geometry[0], geometry[1], minz, maxz)])
+            return
+
+        area = self.query_area(mode, geometry)
+        if area is not None:
+            self.create_result_table(self.range_search_batches(*area, minz, maxz))
+
+    def query(self, mode, geometry, minz=None, maxz=None, arrow=False):
+        """
+        Runs a query in-process and returns the points, without creating a result table.
+
+        Args:
+            mode (str): "bbox", "circle", "polygon" or "nn"
+            geometry: [x_min, x_max, y_min, y_max], [[cx, cy], r], a polygon as WKT or shapely geometry,
+                or [[x, y], k] for the k nearest neighbours
+            minz (float): optional lower z bound
+            maxz (float): optional upper z bound
+            arrow (bool): return a pyarrow RecordBatch with x, y, z columns instead of an array
+
+        Returns:
+            np.ndarray: (N, 3) array of x, y, z, or a pyarrow.RecordBatch
+        """
+        if mode == "nn":
+            points = self.nn_query(geometry[0], geometry[1], minz, maxz)
+        else:
+            area = self.query_area(mode, geometry)
+            if area is None:
+                return None
+            points = self.range_search(*area, minz, maxz)
+
+        if arrow:
+            return to_record_batch(points)
+        return points
+
+    def query_area(self, mode, geometry):
+        """
+        Returns the bounding box of the query geometry and the region the points are refined
+        against: None for a box, the circle itself, or the polygon as shapely geometry.
+        """
         if mode == "bbox":
-            self.bbox_query(geometry)
+            return geometry, None
         elif mode == "circle":
-            self.circle_query(geometry)
+            center_x, center_y, radius = geometry[0][0], geometry[0][1], geometry[1]
+            return [center_x - radius, center_x + radius, center_y - radius, center_y + radius], geometry
         elif mode == "polygon":
-            self.polygon_query(geometry)
-        elif mode == "nn":
-            print("nn search is not developed yet.")
+            polygon = loads(geometry) if isinstance(geometry, str) else geometry
+            x_min, y_min, x_max, y_max = polygon.bounds
+            return [x_min, x_max, y_min, y_max], polygon
+        else:
+            print(f"Error: Unknown query mode {mode}.")
+        return None
 
-    def bbox_query(self, bbox):
-        self.range_search(bbox)
+    def bbox_query(self, bbox, minz=None, maxz=None):
+        return self.query("bbox", bbox, minz, maxz)
 
-    def circle_query(self, geometry):
-        # 1. Compute bounding box
-        center_x, center_y, radius = geometry[0][0], geometry[0][1], geometry[1]
-        x_min, x_max = center_x - radius, center_x + radius
-        y_min, y_max = center_y - radius, center_y + radius
-        bbox = [x_min, x_max, y_min, y_max]
+    def circle_query(self, geometry, minz=None, maxz=None):
+        return self.query("circle", geometry, minz, maxz)
 
-        # 2. Range search based on bounding box and create table as intermediate result
-        self.range_search(bbox)
+    def polygon_query(self, polygon, minz=None, maxz=None):
+        return self.query("polygon", polygon, minz, maxz)
 
-        # 3. Use PostGIS function to query the points inside the circle, create table as result
-        circle_query = f"""
-            DELETE FROM {self.name}
-            WHERE NOT ST_DWithin(point, ST_MakePoint({center_x}, {center_y}), {radius});
+    def aggregate_query(self, mode, geometry, minz=None, maxz=None, bins=10):
         """
-        self.cursor.execute(circle_query)
-        self.connection.commit()
-        print(f"Circle search is updated in {self.name}.")
+        Computes the point count, the z min, max and mean and a z histogram of a query
+        without returning the points. The fully contained heads whose stored z range lies
+        within the z bounds are summarized from their block statistics, only the other
+        heads are fetched and decoded.
+
+        Args:
+            mode (str): "bbox", "circle" or "polygon"
+            geometry: the query geometry, as for query()
+            minz (float): optional lower z bound
+            maxz (float): optional upper z bound
+            bins (int): the number of histogram bins
+
+        Returns:
+            dict: count, z_min, z_max, z_mean and histogram (bin counts, bin edges)
+        """
+        area = self.query_area(mode, geometry)
+        if area is None:
+            return None
+        bbox, region = area
+        self.source_table = self.base_table  # statistics are always taken from all points
+
+        # 1. The heads of the query with their block statistics, an index-only lookup
+        head_ranges, full, stats = morton_cover(bbox if region is None else region, 0, self.head_len, self.tail_len,
+                                                self.max_ranges)
+        heads, n_points, z_min, z_max, is_full = self.block_stats(head_ranges, full, minz, maxz)
+        inside = is_full & (z_min >= (-np.inf if minz is None else minz)) & (z_max <= (np.inf if maxz is None else maxz))
+
+        lo = z_min.min() if len(heads) else 0.0
+        hi = z_max.max() if len(heads) else 1.0
+        lo, hi = (lo if minz is None else max(lo, minz)), (hi if maxz is None else min(hi, maxz))
+        edges = np.linspace(lo, hi if hi > lo else lo + 1, bins + 1)
+        result = {"count": 0, "z_min": np.inf, "z_max": -np.inf, "z_sum": 0.0, "histogram": np.zeros(bins, np.int64)}
 
-    def polygon_query(self, wkt_string):
-        # 1. Compute bounding box
-        polygon = loads(wkt_string)
-        exterior_coords = list(polygon.exterior.coords)
-        x = [pt[0] for pt in exterior_coords]
-        y = [pt[1] for pt in exterior_coords]
-        bbox = [min(x), max(x), min(y), max(y)]
+        # 2. Fully contained heads within the z bounds: count and z range from the block statistics
+        if inside.any():
+            result["count"] += int(n_points[inside].sum())
+            result["z_min"] = min(result["z_min"], z_min[inside].min())
+            result["z_max"] = max(result["z_max"], z_max[inside].max())
+            z_sum, histogram = self.z_summary(heads[inside], edges, minz, maxz)
+            result["z_sum"] += z_sum
+            result["histogram"] += histogram
 
-        # 2. Range search based on bounding box and create table as intermediate result
-        self.range_search(bbox)
+        # 3. The other heads are fetched and refined point by point
+        rest = ~inside
+        ranges = np.column_stack((heads[rest], heads[rest])).reshape(-1, 2)
+        if len(ranges) > 0:
+            for res1, res2 in self.fetch_blocks(self.connection, ranges, is_full[rest], None, minz, maxz):
+                z = self.process_blocks(res1, res2, bbox, region, minz, maxz)[:, 2]
+                if len(z) > 0:
+                    result["count"] += len(z)
+                    result["z_min"] = min(result["z_min"], z.min())
+                    result["z_max"] = max(result["z_max"], z.max())
+                    result["z_sum"] += z.sum()
+                    result["histogram"] += np.histogram(z, edges)[0]
 
-        # 3. Use PostGIS function to query the points inside the circle, create table as result
-        polygon_query = f"""
-            DELETE FROM {self.name}
-            WHERE NOT ST_Within(point, ST_GeomFromText('{wkt_string}'))
+        print(f"Aggregate: {int(inside.sum())} heads from block statistics, {int(rest.sum())} heads decoded")
+        count = result["count"]
+        return {
+            "count": count,
+            "z_min": float(result["z_min"]) if count else None,
+            "z_max": float(result["z_max"]) if count else None,
+            "z_mean": result["z_sum"] / count if count else None,
+            "histogram": (result["histogram"], edges)
+        }
+
+    def block_stats(self, head_ranges, full, minz=None, maxz=None):
         """
-        self.cursor.execute(polygon_query)
-        self.connection.commit()
-        print(f"Polygon search is updated in {self.name}.")
+        Lists the heads stored in the ranges with their point count and z range, skipping
+        the blocks entirely outside the z bounds.
 
-    def maxz_query(self, maxz):
-        z_query = f"""
-            DELETE FROM {self.name}
-            WHERE ST_Z(point) > {maxz}
+        Returns:
+            (np.ndarray, ...): sfc_head, n_points, z_min, z_max and the full flag of every head
         """
-        self.cursor.execute(z_query)
-        self.connection.commit()
-        print(f"Max height search is updated in {self.name}.")
+        z_sql, z_params = self.z_filter(minz, maxz)
+        self.cursor.execute(f'''
+            SELECT b.sfc_head, SUM(b.n_points), MIN(b.z_min), MAX(b.z_max), bool_or(r.is_full)
+            FROM unnest(%s::INT[], %s::INT[], %s::BOOLEAN[]) AS r(range_start, range_end, is_full)
+            CROSS JOIN LATERAL (
+                SELECT sfc_head, n_points, z_min, z_max FROM {self.source_table}
+                WHERE sfc_head BETWEEN r.range_start AND r.range_end{z_sql}
+            ) AS b
+            GROUP BY b.sfc_head
+            ORDER BY b.sfc_head
+        ''', (head_ranges[:, 0].tolist(), head_ranges[:, 1].tolist(), full.tolist(), *z_params))
+        rows = self.cursor.fetchall()
+        return (np.array([row[0] for row in rows], dtype=np.int64),
+                np.array([row[1] for row in rows], dtype=np.int64),
+                np.array([row[2] for row in rows], dtype=np.float64),
+                np.array([row[3] for row in rows], dtype=np.float64),
+                np.array([row[4] for row in rows], dtype=bool))
 
-    def minz_query(self, minz):
-        z_query = f"""
-            DELETE FROM {self.name}
-            WHERE ST_Z(point) < {minz}
+    def z_summary(self, heads, edges, minz=None, maxz=None):
         """
-        self.cursor.execute(z_query)
-        self.connection.commit()
-        print(f"Min height search is updated in {self.name} successfully.")
+        Sums the z values of whole heads within the z bounds and counts them into the
+        histogram bins, without decoding any x and y. The mean and the histogram need every
+        z value: the array format is summarized by the database, the compact blocks are
+        decoded client-side with their tails skipped. The bounds are applied per value, as
+        fragments of a head may lie outside them.
 
-    def range_search(self, bbox):
-        # 1. Find the fully containing and overlapping heads
-        head_ranges, head_overlaps = morton_range(bbox, 0, self.head_len, self.tail_len)
+        Returns:
+            (float, np.ndarray): the sum of z and the bin counts
+        """
+        bins = len(edges) - 1
+        z_sql, z_params = self.z_filter(minz, maxz)
+        if self.compressed:
+            z_sum, histogram = 0.0, np.zeros(bins, np.int64)
+            with self.connection.cursor(name="z_cursor") as cursor:
+                cursor.itersize = self.batch_size
+                cursor.execute(f"SELECT n_points, block FROM {self.source_table} WHERE sfc_head = ANY(%s){z_sql}",
+                               [heads.tolist(), *z_params])
+                while True:
+                    rows = cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+                    z, start = np.empty(sum(row[0] for row in rows), dtype=np.float64), 0
+                    for n_points, block in rows:
+                        start += decode_block_z_into(block, z[start:start + n_points])
+                    z = z[(z >= (-np.inf if minz is None else minz)) & (z <= (np.inf if maxz is None else maxz))]
+                    z_sum += z.sum()
+                    histogram += np.histogram(z, edges)[0]
+            return z_sum, histogram
 
-        # 2. Take these heads out of the database
-        ## 2.1 Range query
-        # Create a range table and insert data
-        self.cursor.execute('DROP TABLE IF EXISTS RangeTable')
-        self.cursor.execute('''CREATE TEMP TABLE RangeTable (range_start INT, range_end INT)''')
-        self.cursor.executemany('INSERT INTO RangeTable (range_start, range_end) VALUES (%s, %s)', head_ranges)
+        v_sql, v_params = "", []
+        if minz is not None:
+            v_sql += " AND v >= %s"
+            v_params.append(minz)
+        if maxz is not None:
+            v_sql += " AND v <= %s"
+            v_params.append(maxz)
 
+        # width_bucket puts the upper edge into bin n + 1, np.histogram into the last bin
         self.cursor.execute(f'''
-            SELECT * FROM {self.source_table} 
-            WHERE EXISTS (
-                SELECT 1 FROM RangeTable 
-                WHERE {self.source_table}.sfc_head BETWEEN RangeTable.range_start AND RangeTable.range_end
-            )
-        ''')
-        res1 = self.cursor.fetchall() # data type: a list of tuple ?
+            SELECT GREATEST(LEAST(width_bucket(v, %s, %s, %s), %s), 1) AS bucket, COUNT(*), SUM(v)
+            FROM {self.source_table} AS b, unnest(b.z) AS v
+            WHERE b.sfc_head = ANY(%s){z_sql}{v_sql}
+            GROUP BY bucket
+        ''', (float(edges[0]), float(edges[-1]), bins, bins, heads.tolist(), *z_params, *v_params))
+        z_sum, histogram = 0.0, np.zeros(bins, np.int64)
+        for bucket, count, bucket_sum in self.cursor.fetchall():
+            histogram[bucket - 1] += count
+            z_sum += bucket_sum
+        return z_sum, histogram
+
+    def nn_query(self, point, k, minz=None, maxz=None):
+        """
+        Finds the k nearest neighbours of a point in x and y. The search expands outward
+        in square rings of head cells and every ring only fetches the heads it adds. A
+        bounded max-heap keeps the k best candidates. All points inside the searched square
+        have been seen, so the search stops once the k-th distance is within its radius.
+
+        Args:
+            point (list): x, y of the query point
+            k (int): the number of neighbours
+            minz (float): optional lower z bound
+            maxz (float): optional upper z bound
+
+        Returns:
+            np.ndarray: (k, 3) array of x, y, z, nearest first
+        """
+        x, y = point
+        self.source_table = self.base_table
+        # Largest coordinates of the key space, x takes the extra bit of an odd key length
+        key_len = self.head_len + self.tail_len
+        x_extent, y_extent = 2 ** ((key_len + 1) // 2) - 1, 2 ** (key_len // 2) - 1
+        radius = 2 ** (self.tail_len // 2)  # start with the neighbouring head cells
+        heap = []  # (-distance, x, y, z) of the best candidates
+        searched = np.empty((0, 2), dtype=np.int64)
+        n_rings = 0
+
+        while True:
+            # 1. The heads of the square that the previous rings did not cover
+            bbox = [max(x - radius, 0), min(x + radius, x_extent), max(y - radius, 0), min(y + radius, y_extent)]
+            full_ranges, overlaps = morton_range(bbox, 0, self.head_len, self.tail_len)
+            square = np.array(sorted(full_ranges + [[head, head] for head in overlaps]), dtype=np.int64).reshape(-1, 2)
+            ring = subtract_ranges(square, searched)
+            searched = square
+            n_rings += 1
+
+            # 2. Keep the k nearest points of the ring
+            for res1, res2 in self.fetch_blocks(self.connection, ring, np.ones(len(ring), dtype=bool), None, minz, maxz):
+                points = self.refine(self.decode_blocks(res1 + res2), None, minz, maxz)
+                distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+                if len(heap) == k:
+                    closer = distances < -heap[0][0]
+                    points, distances = points[closer], distances[closer]
+                if len(distances) > k:
+                    nearest = np.argpartition(distances, k)[:k]
+                    points, distances = points[nearest], distances[nearest]
+                for d, (px, py, pz) in zip(distances, points):
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, px, py, pz))
+                    elif d < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d, px, py, pz))
+
+            # 3. Stop when no unseen point can be closer, or the whole key space was searched
+            if len(heap) == k and -heap[0][0] <= radius:
+                break
+            if bbox == [0, x_extent, 0, y_extent]:
+                break
+            radius = -heap[0][0] if len(heap) == k else radius * 2
+
+        print(f"nn search: {len(heap)} neighbours within {round(radius, 3)} after {n_rings} rings")
+        neighbours = sorted(heap, reverse=True)
+        return np.array([[px, py, pz] for (_, px, py, pz) in neighbours], dtype=np.float64).reshape(-1, 3)
+
+    def range_search(self, bbox, region=None, minz=None, maxz=None):
+        batches = list(self.range_search_batches(bbox, region, minz, maxz))
+        return np.vstack(batches) if batches else np.empty((0, 3))
+
+    def range_search_batches(self, bbox, region=None, minz=None, maxz=None):
+        """
+        Yields the refined points of the query batch by batch, so that only
+        batch_size blocks are held in memory at a time.
+        """
+        # 1. Plan the query: find the fully containing and overlapping head ranges, against the circle
+        # or polygon if given, and choose how to read them
+        plan, head_ranges, full = self.plan(bbox, region, minz, maxz)
+        if plan == "empty":
+            return
+        self.source_table = self.choose_level(head_ranges, bbox)
+        if plan == "scan":
+            for res1, res2 in self.fetch_blocks(self.connection, head_ranges, full, None, minz, maxz, scan=True):
+                yield self.process_blocks(res1, res2, bbox, region, minz, maxz)
+            return
+
+        # 2. Serve the cached heads and only fetch the missing ones
+        cacheable = None
+        if self.cache is not None:
+            cached_full, cached_partial, head_ranges, full, cacheable = self.split_cached(head_ranges, full, minz, maxz)
+            if cached_full or cached_partial:
+                yield self.process_blocks(cached_full, cached_partial, bbox, region, minz, maxz)
+            if len(head_ranges) == 0:
+                return
+
+        # 3. Take these heads out of the database, a batch of blocks at a time
+        if self.workers > 1 and len(head_ranges) > 0:
+            yield from self.parallel_batches(head_ranges, full, bbox, region, minz, maxz, cacheable)
+            return
+
+        for res1, res2 in self.fetch_blocks(self.connection, head_ranges, full, cacheable, minz, maxz):
+            yield self.process_blocks(res1, res2, bbox, region, minz, maxz)
 
-        ## 2.2 Overlaps Query
-        self.cursor.execute(f'''SELECT * FROM {self.source_table} WHERE sfc_head = ANY(%s)''', (head_overlaps,))
-        res2 = self.cursor.fetchall()
+    def plan(self, bbox, region=None, minz=None, maxz=None):
+        """
+        Chooses how a range search reads its heads, from the dataset bbox and the block
+        statistics in the metadata, and logs the choice:
+            "empty": the query misses the dataset, the database is not queried
+            "point": the query lies within one head, a single index lookup
+            "ranges": the head ranges joined laterally, merged down to a budget when
+                descending the index for every range costs more than the blocks it fetches
+            "scan": a sequential scan, the blocks are matched to the ranges client-side
+
+        Returns:
+            (str, np.ndarray, np.ndarray): the plan, the head ranges and their full flags
+        """
+        meta = self.metadata()
+        scales, offsets, ds_bbox = meta["scales"], meta["offsets"], meta["bbox"]
+        no_ranges = np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=bool)
 
-        # 3. Unpack the point block and decode
-        points_within_bbox = []
-        for (sfc_head, sfc_tail, z) in res1:
-            for i in range(len(sfc_tail)):
-                sfc_key = sfc_head << self.tail_len | sfc_tail[i]
-                x, y = DecodeMorton2D(sfc_key)
-                points_within_bbox.append([x, y, z[i]])
+        # 1. Short-circuit queries outside the dataset bbox, in the coordinates of the keys
+        ds = [np.floor((ds_bbox[0] - offsets[0]) / scales[0]), np.ceil((ds_bbox[1] - offsets[0]) / scales[0]),
+              np.floor((ds_bbox[2] - offsets[1]) / scales[1]), np.ceil((ds_bbox[3] - offsets[1]) / scales[1])]
+        overlap_x = min(bbox[1], ds[1]) - max(bbox[0], ds[0])
+        overlap_y = min(bbox[3], ds[3]) - max(bbox[2], ds[2])
+        if (overlap_x < 0 or overlap_y < 0 or (minz is not None and minz > round(ds_bbox[5], 2))
+                or (maxz is not None and maxz < round(ds_bbox[4], 2))):
+            print("Plan: empty, the query is outside the dataset")
+            return ("empty", *no_ranges)
+
+        head_ranges, full, stats = morton_cover(bbox if region is None else region, 0, self.head_len, self.tail_len,
+                                                self.max_ranges)
+        print(f"Head ranges: {stats}")
+        if len(head_ranges) == 0:
+            print("Plan: empty, no head in the query region")
+            return ("empty", *no_ranges)
+        if len(head_ranges) == 1 and head_ranges[0, 0] == head_ranges[0, 1]:
+            print(f"Plan: point, head {head_ranges[0, 0]}")
+            return "point", head_ranges, full
+
+        # 2. Estimate the blocks of the query, assuming a uniform density over the dataset bbox
+        blocks = meta.get("block_count")
+        if not blocks:
+            print(f"Plan: ranges, {len(head_ranges)} ranges, no block statistics")
+            return "ranges", head_ranges, full
+        selectivity = min(max(overlap_x, 1) * max(overlap_y, 1) / max((ds[1] - ds[0]) * (ds[3] - ds[2]), 1), 1)
+        estimate = blocks * selectivity
+        budget = len(head_ranges) if self.max_ranges is not None else max(int(estimate / RANGE_COST), MIN_RANGES)
+
+        # 3. Compare the index lookups of the (merged) ranges with a sequential scan
+        range_cost = min(len(head_ranges), budget) * RANGE_COST + estimate
+        scan_cost = blocks * SCAN_BLOCK_COST
+        if scan_cost < range_cost:
+            plan = "scan"
+        else:
+            plan = "ranges"
+            if len(head_ranges) > budget:
+                head_ranges, full, stats = morton_cover(bbox if region is None else region, 0, self.head_len,
+                                                        self.tail_len, budget)
+        print(f"Plan: {plan}, selectivity {selectivity:.4f}, ~{int(estimate)} of {blocks} blocks, "
+              f"{len(head_ranges)} ranges, cost {range_cost:.0f} by ranges / {scan_cost:.0f} by scan")
+        return plan, head_ranges, full
+
+    def choose_level(self, head_ranges, bbox):
+        """
+        Picks the table a range search reads from. Without a point budget or a target
+        density this is the base table. Otherwise the points of every level in the head
+        ranges are counted from the block statistics: with max_points the finest level
+        within the budget is read, with density the coarsest level that is still at least
+        as dense over the query box. If no level satisfies it, the coarsest one is read.
+        """
+        if self.max_points is None and self.density is None:
+            return self.base_table
+        lod_levels = sorted(self.metadata()["lod_levels"] or [])
+        if not lod_levels:
+            return self.base_table
 
+        area = max((bbox[1] - bbox[0]) * (bbox[3] - bbox[2]), 1)
+        tables = [self.base_table] + [f"{self.base_table}_lod{level}" for level in lod_levels]
+        counts = [self.table_count(table, head_ranges) for table in tables]
+
+        if self.density is not None:
+            dense = [table for table, count in zip(tables, counts) if count / area >= self.density]
+            table = dense[-1] if dense else tables[0]
+        else:
+            within = [table for table, count in zip(tables, counts) if count <= self.max_points]
+            table = within[0] if within else tables[-1]
+        print(f"Level of detail: {table}, {dict(zip(tables, counts))} points in the head ranges")
+        return table
+
+    def metadata(self):
+        """
+        Returns the metadata row of the source dataset as a dict, read once per Querier.
+        """
+        if self.meta is None:
+            meta_table = self.base_table.replace("pc_record_", "pc_metadata_", 1)
+            self.cursor.execute(f"SELECT * FROM {meta_table} LIMIT 1")
+            columns = [column[0] for column in self.cursor.description]
+            self.meta = dict(zip(columns, self.cursor.fetchone()))
+        return self.meta
+
+    def table_count(self, table, head_ranges):
+        # Points stored in the head ranges, from the block statistics (an index-only scan)
+        self.cursor.execute(f'''
+            SELECT COALESCE(SUM(b.n_points), 0)
+            FROM unnest(%s::INT[], %s::INT[]) AS r(range_start, range_end)
+            CROSS JOIN LATERAL (
+                SELECT n_points FROM {table}
+                WHERE sfc_head BETWEEN r.range_start AND r.range_end
+            ) AS b
+        ''', (head_ranges[:, 0].tolist(), head_ranges[:, 1].tolist()))
+        return int(self.cursor.fetchone()[0])
+
+    def split_cached(self, head_ranges, full, minz=None, maxz=None):
+        """
+        Lists the heads stored in the ranges (an index-only lookup) and takes the cached
+        ones from the block cache. Heads entirely outside the z bounds are left out.
+
+        Returns:
+            (list, list, np.ndarray, np.ndarray, set): cached full and partial blocks, the
+                ranges and flags of the missing heads, and the missing heads that are stored
+                as a single row and can be cached once fetched
+        """
+        # The rows are counted without the z bounds, a head is only cacheable when its single row
+        # is fetched whole; a head is listed when any of its rows is within the bounds
+        z_sql, z_params = self.z_filter(minz, maxz)
+        self.cursor.execute(f'''
+            SELECT b.sfc_head, bool_or(r.is_full), COUNT(*)
+            FROM unnest(%s::INT[], %s::INT[], %s::BOOLEAN[]) AS r(range_start, range_end, is_full)
+            CROSS JOIN LATERAL (
+                SELECT sfc_head, TRUE{z_sql} AS in_z FROM {self.source_table}
+                WHERE sfc_head BETWEEN r.range_start AND r.range_end
+            ) AS b
+            GROUP BY b.sfc_head
+            HAVING bool_or(b.in_z)
+            ORDER BY b.sfc_head
+        ''', (head_ranges[:, 0].tolist(), head_ranges[:, 1].tolist(), full.tolist(), *z_params))
+
+        cached_full, cached_partial, cacheable = [], [], set()
+        missing = []  # [start, end, is_full] runs of consecutive missing heads
+        for sfc_head, is_full, n_rows in self.cursor.fetchall():
+            block = self.cache.get(self.source_table, sfc_head)
+            if block is not None:
+                (cached_full if is_full else cached_partial).append((sfc_head, *block))
+                continue
+
+            if n_rows == 1:
+                cacheable.add(sfc_head)
+            # Only adjacent heads are merged, a gap may hold stored heads outside the query
+            if missing and missing[-1][1] + 1 == sfc_head and missing[-1][2] == is_full:
+                missing[-1][1] = sfc_head
+            else:
+                missing.append([sfc_head, sfc_head, is_full])
+
+        missing_ranges = np.array([[start, end] for start, end, _ in missing], dtype=np.int64).reshape(-1, 2)
+        missing_full = np.array([is_full for _, _, is_full in missing], dtype=bool)
+        print(f"Block cache: {len(cached_full) + len(cached_partial)} heads cached, {len(missing)} ranges to fetch")
+        return cached_full, cached_partial, missing_ranges, missing_full, cacheable
+
+    def parallel_batches(self, head_ranges, full, bbox, region=None, minz=None, maxz=None, cacheable=None):
+        """
+        Splits the head ranges into balanced partitions, fetches and decodes every partition
+        on its own pooled connection in a worker thread, and yields the batches as they finish.
+        """
+        # Ranges without any stored point are dropped, the others are balanced by their point counts
+        weights = self.range_weights(head_ranges)
+        head_ranges, full, weights = head_ranges[weights > 0], full[weights > 0], weights[weights > 0]
+        if len(head_ranges) == 0:
+            return
+        partitions = partition_ranges(head_ranges, full, weights, self.workers)
+        print(f"Parallel query: {len(partitions)} partitions")
+        if self.pool is None:
+            self.pool = ThreadedConnectionPool(1, self.workers, **{key: self.db_conf[key] for key in
+                                               ["dbname", "user", "password", "host", "port"]})
+        batches = queue.Queue(maxsize=4 * self.workers)
+        stop = threading.Event()  # set when the consumer fails or stops early
+
+        def put(item):
+            # Gives up once stopped, so that no worker stays blocked on a full queue
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work(ranges, flags):
+            connection = self.pool.getconn()
+            try:
+                for res1, res2 in self.fetch_blocks(connection, ranges, flags, cacheable, minz, maxz):
+                    if not put(self.process_blocks(res1, res2, bbox, region, minz, maxz)):
+                        break
+            except Exception as e:
+                put(e)
+            finally:
+                connection.rollback()
+                self.pool.putconn(connection)
+                put(None)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for ranges, flags in partitions:
+                executor.submit(work, ranges, flags)
+
+            try:
+                running = len(partitions)
+                while running > 0:
+                    batch = batches.get()
+                    if batch is None:
+                        running -= 1
+                    elif isinstance(batch, Exception):
+                        raise batch
+                    else:
+                        yield batch
+            finally:
+                # Release the workers before the executor waits for them
+                stop.set()
+                while True:
+                    try:
+                        batches.get_nowait()
+                    except queue.Empty:
+                        break
+
+    def range_weights(self, head_ranges):
+        # Expected amount of work per range: the points stored in it, from the block statistics
+        self.cursor.execute(f'''
+            SELECT COALESCE(SUM(b.n_points), 0)
+            FROM unnest(%s::INT[], %s::INT[]) WITH ORDINALITY AS r(range_start, range_end, i)
+            LEFT JOIN LATERAL (
+                SELECT n_points FROM {self.source_table}
+                WHERE sfc_head BETWEEN r.range_start AND r.range_end
+            ) AS b ON TRUE
+            GROUP BY r.i
+            ORDER BY r.i
+        ''', (head_ranges[:, 0].tolist(), head_ranges[:, 1].tolist()))
+        return np.array([weight for (weight,) in self.cursor.fetchall()], dtype=np.int64)
+
+    def z_filter(self, minz=None, maxz=None):
+        """
+        Returns the SQL condition and its parameters that skip the blocks entirely
+        below or above the z bounds, using the stored z_min and z_max of every block.
+        """
+        z_sql, z_params = "", []
+        if minz is not None:
+            z_sql += " AND z_max >= %s"
+            z_params.append(minz)
+        if maxz is not None:
+            z_sql += " AND z_min <= %s"
+            z_params.append(maxz)
+        return z_sql, z_params
+
+    def process_blocks(self, res1, res2, bbox, region=None, minz=None, maxz=None):
+        # Filter the tails of the partial blocks
+        overlap_blocks = []
         for (sfc_head, sfc_tail, z) in res2:  # Each group
             # Check which tails of this head in within the ranges
             tail_rgs, tail_ols = morton_range(bbox, sfc_head, self.tail_len, 0)
-            # Unpack the tails
-            for i in range(len(sfc_tail)):  # Each point
-                # Check if the tail in within the ranges
-                check_in_range = any(start <= sfc_tail[i] <= end for start, end in tail_rgs)
-                if check_in_range == 1:
-                    sfc_key = sfc_head << self.tail_len | sfc_tail[i]
-                    x, y = DecodeMorton2D(sfc_key)
-                    points_within_bbox.append([x, y, z[i]])
-
-        # 4. Create results as a table
-        self.cursor.execute(f"CREATE TABLE {self.name} (point geometry(PointZ));")
-        insert_sql = f"INSERT INTO {self.name} VALUES (ST_MakePoint(%s, %s, %s));"
-        for point in points_within_bbox:
-            self.cursor.execute(insert_sql, point)
+            in_range = tails_in_ranges(sfc_tail, tail_rgs)
+            overlap_blocks.append((sfc_head, sfc_tail[in_range], z[in_range]))
+
+        # Decode the blocks in one batch and refine: the full blocks only need the z bounds,
+        # the partial blocks also the geometry
+        full_points = self.refine(self.decode_blocks(res1), None, minz, maxz)
+        partial_points = self.refine(self.decode_blocks(overlap_blocks), region, minz, maxz)
+        return np.vstack((full_points, partial_points))
+
+    def fetch_blocks(self, connection, head_ranges, full, cacheable=None, minz=None, maxz=None, scan=False):
+        """
+        Fetches the blocks of all head ranges in one statement. The ranges are sent as
+        arrays and joined laterally, so every range becomes an index range scan on
+        sfc_head; a single range is a plain index lookup. With scan, the whole table is
+        read sequentially and the blocks are matched to the ranges client-side. The z
+        bounds are pushed into the scan, and a named (server-side) cursor streams the
+        result in batches.
+
+        Yields:
+            (list, list): (sfc_head, sfc_tail, z) blocks of the fully contained and of the
+                partially overlapping ranges, with the tails and z as arrays
+        """
+        columns = "block" if self.compressed else "sfc_tail, z"
+        z_sql, z_params = self.z_filter(minz, maxz)
+        if scan:
+            sql = f"SELECT sfc_head, n_points, {columns}, FALSE FROM {self.source_table} WHERE TRUE{z_sql}"
+            params = z_params
+        elif len(head_ranges) == 1:
+            sql = (f"SELECT sfc_head, n_points, {columns}, %s FROM {self.source_table} "
+                   f"WHERE sfc_head BETWEEN %s AND %s{z_sql}")
+            params = [bool(full[0]), int(head_ranges[0, 0]), int(head_ranges[0, 1]), *z_params]
+        else:
+            sql = f'''
+                SELECT sfc_head, n_points, {columns}, r.is_full
+                FROM unnest(%s::INT[], %s::INT[], %s::BOOLEAN[]) AS r(range_start, range_end, is_full)
+                CROSS JOIN LATERAL (
+                    SELECT * FROM {self.source_table}
+                    WHERE sfc_head BETWEEN r.range_start AND r.range_end{z_sql}
+                ) AS b
+            '''
+            params = [head_ranges[:, 0].tolist(), head_ranges[:, 1].tolist(), full.tolist(), *z_params]
+
+        with connection.cursor(name="block_cursor") as cursor:
+            cursor.itersize = self.batch_size
+            cursor.execute(sql, params)
+
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                if scan:
+                    rows = self.match_ranges(rows, head_ranges, full)
+                    if not rows:
+                        continue
+                blocks = self.unpack_rows(rows)
+                if cacheable:
+                    for (sfc_head, sfc_tail, z) in blocks:
+                        if sfc_head in cacheable:
+                            self.cache.put(self.source_table, sfc_head, sfc_tail.copy(), z.copy())
+
+                full_rows = [block for block, row in zip(blocks, rows) if row[-1]]
+                partial_rows = [block for block, row in zip(blocks, rows) if not row[-1]]
+                yield full_rows, partial_rows
+
+    def match_ranges(self, rows, head_ranges, full):
+        # Keeps the scanned rows whose head lies in a range, with the full flag of that range
+        heads = np.array([row[0] for row in rows], dtype=np.int64)
+        idx = np.searchsorted(head_ranges[:, 0], heads, side='right') - 1
+        inside = (idx >= 0) & (heads <= head_ranges[idx, 1])
+        return [row[:-1] + (bool(full[i]),) for row, i, keep in zip(rows, idx, inside) if keep]
+
+    def unpack_rows(self, rows):
+        """
+        Unpacks a batch of (sfc_head, n_points, sfc_tail, z | block, is_full) rows into one
+        tail and one z buffer, pre-sized from the stored point counts.
+
+        Returns:
+            list: (sfc_head, sfc_tail, z) blocks, with views of the buffers as tails and z
+        """
+        ends = np.cumsum([row[1] for row in rows])
+        tails = np.empty(ends[-1], dtype=np.int64)
+        z = np.empty(ends[-1], dtype=np.float64)
+
+        blocks, start = [], 0
+        for row, end in zip(rows, ends):
+            if self.compressed:
+                decode_block_into(row[2], tails[start:end], z[start:end])
+            else:
+                tails[start:end] = row[2]
+                z[start:end] = row[3]
+            blocks.append((row[0], tails[start:end], z[start:end]))
+            start = end
+        return blocks
+
+    def refine(self, points, region=None, minz=None, maxz=None):
+        """
+        Applies the geometry and the z bounds to decoded (N, 3) points in one vectorized pass.
+
+        Args:
+            points (np.ndarray): x, y, z of the candidate points
+            region: None, a circle [[cx, cy], r] or a shapely geometry
+            minz (float): optional lower z bound
+            maxz (float): optional upper z bound
+
+        Returns:
+            np.ndarray: the points that satisfy every predicate
+        """
+        keep = np.ones(len(points), dtype=bool)
+        if isinstance(region, BaseGeometry):
+            keep &= shapely.contains_xy(region, points[:, 0], points[:, 1])
+        elif region is not None:
+            (center_x, center_y), radius = region
+            keep &= (points[:, 0] - center_x) ** 2 + (points[:, 1] - center_y) ** 2 <= radius ** 2
+        if minz is not None:
+            keep &= points[:, 2] >= minz
+        if maxz is not None:
+            keep &= points[:, 2] <= maxz
+        return points[keep]
+
+    def create_result_table(self, batches):
+        # COPY the point batches in binary into a staging table, then build the geometries in one statement
+        staging = f"{self.name}_staging"
+        self.cursor.execute(f"CREATE TEMP TABLE {staging} (x DOUBLE PRECISION, y DOUBLE PRECISION, "
+                            f"z DOUBLE PRECISION) ON COMMIT DROP;")
+        n_points = 0
+        for points in batches:
+            self.cursor.copy_expert(f"COPY {staging} FROM stdin WITH (FORMAT binary)",
+                                    io.BytesIO(pack_points(points)))
+            n_points += len(points)
+        self.cursor.execute(f"CREATE TABLE {self.name} AS "
+                            f"SELECT ST_MakePoint(x, y, z)::geometry(PointZ) AS point FROM {staging};")
         self.connection.commit()
-        print(f"Points within the bounding box are inserted into the table '{self.name}'.")
+        print(f"{n_points} points are inserted into the table '{self.name}'.")
 
+    def decode_blocks(self, blocks):
+        """
+        Decodes (sfc_head, sfc_tail, z) blocks with array tails and z into an (N, 3) array of x, y, z.
+        """
+        if not blocks:
+            return np.empty((0, 3))
+        counts = [len(sfc_tail) for (_, sfc_tail, _) in blocks]
+        heads = np.repeat(np.array([sfc_head for (sfc_head, _, _) in blocks], dtype=np.int64), counts)
+        tails = np.concatenate([sfc_tail for (_, sfc_tail, _) in blocks]).astype(np.int64, copy=False)
+        z = np.concatenate([z for (_, _, z) in blocks]).astype(np.float64, copy=False)
+        return DecodeJoinBatch(heads, tails, z, self.tail_len)
 
     def disconnect(self):
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
         if self.connection:
             self.cursor.close()
             self.connection.close()
             self.connection = None
-            self.cursor = None
\ No newline at end of file
+            self.cursor = None
+
+
+def to_record_batch(points):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print("Error: pyarrow is required for Arrow results.")
+        return None
+    return pa.RecordBatch.from_arrays([pa.array(points[:, 0]), pa.array(points[:, 1]), pa.array(points[:, 2])],
+                                      names=["x", "y", "z"])
@@ -4,6 +4,7 @@ import time
 import argparse
 
 from pipeline.retrieve_data import Querier
+from pipeline.block_cache import BlockCache
 
 def main():
     parser = argparse.ArgumentParser(description='Example of argparse usage.')
@@ -24,7 +25,9 @@ def main():
 
     db_conf = jparams["config"]
     db_conf["password"] = args.password
-    head_len, tail_len = 26, 12
+
+    # Optional cache of decoded head blocks, shared by all queries of this run
+    cache = BlockCache(jparams["cache_mb"] * 1024 * 1024) if "cache_mb" in jparams else None
 
     for key, value in jparams["queries"].items():
         start_time = time.time()
@@ -33,15 +36,19 @@ def main():
         print(f"=== {mode} query {key} from {source_table} ===")
 
         try:
-            pipeline = Querier(head_len, tail_len, db_conf, source_table, query_name)
-            pipeline.geometry_query(mode, geometry)
-
-            if "maxz" in value:
-                pipeline.maxz_query(value["maxz"])
-            if "minz" in value:
-                pipeline.minz_query(value["minz"])
+            # The split lengths are read from pc_metadata_<name> unless the query overrides them
+            pipeline = Querier(value.get("head_len"), value.get("tail_len"), db_conf, source_table, query_name,
+                               value.get("compressed"), value.get("max_ranges"), value.get("materialize", True),
+                               workers=value.get("workers", 1), cache=cache, max_points=value.get("max_points"),
+                               density=value.get("density"))
+            if value.get("aggregate", False):
+                print(pipeline.aggregate_query(mode, geometry, value.get("minz"), value.get("maxz"), value.get("bins", 10)))
+            else:
+                pipeline.geometry_query(mode, geometry, value.get("minz"), value.get("maxz"))
 
             pipeline.disconnect()
+            if cache is not None:
+                print(f"Block cache: {cache.stats()}")
         except Exception as e:
             print(f"An error occurred: {e}")
 